@@ -0,0 +1,171 @@
+import argparse
+import numpy as np
+from codebook_metrics import load_condition
+from codebook_archive import get_archive
+
+# Offline stand-in for a participant: the attended object's codebook sequence is turned into a single EEG
+# channel by a linear response model plus noise, and decoded by correlating with the noise-free responses of
+# all objects (template matching). Codebooks are (..., n_objs, n_steps) as in codebook_metrics.
+FS = 120  # Hz
+
+
+def erp_kernel(fs: float=FS, duration: float=0.8) -> np.ndarray:
+    """ERP to a single flash onset: N1 at 100 ms and a larger P3 at 300 ms"""
+    t = np.arange(int(duration * fs)) / fs
+    return -0.5 * np.exp(-0.5 * ((t - 0.1) / 0.03) ** 2) + np.exp(-0.5 * ((t - 0.3) / 0.08) ** 2)
+
+def cvep_kernel(fs: float=FS, duration: float=0.3) -> np.ndarray:
+    """Impulse response of the visual system to the light intensity: damped ~12 Hz oscillation"""
+    t = np.arange(int(duration * fs)) / fs
+    return np.sin(2 * np.pi * 12 * t) * np.exp(-t / 0.06)
+
+def stimulus_train(codebooks: np.ndarray, fs: float, step_duration: float, on_duration: float=None) -> np.ndarray:
+    """Light intensity sampled at fs: (..., n_objs, n_samples). A highlighted step is on for on_duration."""
+    x = np.asarray(codebooks) == 1
+    samples_per_step = int(round(step_duration * fs))
+    on_samples = samples_per_step if on_duration is None else max(1, int(round(on_duration * fs)))
+    step_shape = np.arange(samples_per_step) < on_samples
+    return (x[..., None] & step_shape).reshape(x.shape[:-1] + (-1,)).astype(float)
+
+def responses(codebooks: np.ndarray, model: str='erp', fs: float=FS, step_duration: float=0.25, on_duration: float=0.1) -> np.ndarray:
+    """Noise-free response to attending each object: (..., n_objs, n_samples).
+
+    'erp' convolves the flash onsets with erp_kernel, 'cvep' convolves the intensity with cvep_kernel.
+    Overlapping responses of fast sequences add up linearly.
+    """
+    train = stimulus_train(codebooks, fs, step_duration, on_duration)
+    if model == 'erp':
+        events = np.diff(train, axis=-1, prepend=0) > 0
+        kernel = erp_kernel(fs)
+    elif model == 'cvep':
+        events = train
+        kernel = cvep_kernel(fs)
+    else:
+        raise ValueError(f'Unknown model: {model}')
+    # Linear convolution of every sequence at once, cut to the stimulation length
+    n_samples = train.shape[-1]
+    n_fft = n_samples + len(kernel) - 1
+    spectrum = np.fft.rfft(events, n=n_fft, axis=-1) * np.fft.rfft(kernel, n=n_fft)
+    return np.fft.irfft(spectrum, n=n_fft, axis=-1)[..., :n_samples]
+
+def noise(shape: tuple, kind: str='white', rng: np.random.Generator=None) -> np.ndarray:
+    """Unit variance background EEG, white or pink (1/f power)"""
+    if rng is None:
+        rng = np.random.default_rng()
+    x = rng.standard_normal(shape)
+    if kind == 'white':
+        return x
+    if kind != 'pink':
+        raise ValueError(f'Unknown noise: {kind}')
+    freqs = np.arange(shape[-1] // 2 + 1)
+    freqs[0] = 1
+    x = np.fft.irfft(np.fft.rfft(x, axis=-1) / np.sqrt(freqs), n=shape[-1], axis=-1)
+    return x / x.std(axis=-1, keepdims=True)
+
+def simulate(templates: np.ndarray, target_ids: np.ndarray, snr: float=0.1, noise_kind: str='white', rng: np.random.Generator=None) -> np.ndarray:
+    """Single-trial EEG (n_trials, n_samples): the target's response scaled to snr (signal to noise
+    power ratio) plus unit variance noise"""
+    signal = templates[target_ids]
+    power = (signal ** 2).mean(axis=-1, keepdims=True)
+    signal = signal * np.sqrt(snr / np.where(power > 0, power, 1))
+    return signal + noise(signal.shape, noise_kind, rng=rng)
+
+def decode(eeg: np.ndarray, templates: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Template matching on the first ends[i] samples of every trial: predicted objects (n_ends, n_trials).
+
+    Correlations for all window lengths come from running sums over the segments between ends,
+    so the cost is a single pass over the data.
+    """
+    n_trials = eeg.shape[0]
+    n_objs = templates.shape[0]
+    sxy = np.zeros((n_trials, n_objs))
+    sx = np.zeros((n_trials, 1))
+    sy = np.zeros(n_objs)
+    syy = np.zeros(n_objs)
+    predictions = np.zeros((len(ends), n_trials), dtype=np.int64)
+    start = 0
+    for i, end in enumerate(ends):
+        x, y = eeg[:, start:end], templates[:, start:end]
+        sxy += x @ y.T
+        sx += x.sum(axis=1, keepdims=True)
+        sy += y.sum(axis=1)
+        syy += (y ** 2).sum(axis=1)
+        start = end
+        # Pearson correlation without the per-trial EEG norm, which does not change the argmax
+        with np.errstate(invalid='ignore', divide='ignore'):
+            scores = (sxy - sx * sy / end) / np.sqrt(syy - sy ** 2 / end)
+        predictions[i] = np.nan_to_num(scores, nan=-np.inf).argmax(axis=1)
+    return predictions
+
+def itr(accuracy: np.ndarray, n_classes: int, trial_duration: np.ndarray) -> np.ndarray:
+    """Wolpaw information transfer rate in bits/min, 0 at or below chance"""
+    p = np.clip(np.asarray(accuracy, dtype=float), 1e-12, 1 - 1e-12)
+    bits = np.log2(n_classes) + p * np.log2(p) + (1 - p) * np.log2((1 - p) / (n_classes - 1))
+    bits = np.where(np.asarray(accuracy) > 1 / n_classes, bits, 0)
+    return bits * 60 / np.asarray(trial_duration)
+
+def evaluate(
+        codebook: np.ndarray, model: str='erp', n_trials: int=1000, n_points: int=12, snr: float=0.1,
+        noise_kind: str='white', fs: float=FS, step_duration: float=0.25, on_duration: float=0.1,
+        inter_trial_duration: float=0.0, rng: np.random.Generator=None
+    ) -> dict:
+    """Accuracy and ITR against trial length for one codebook (n_objs, n_steps).
+
+    Trials have uniformly drawn targets and are decoded after n_points evenly spaced numbers of steps.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    n_objs, n_steps = np.shape(codebook)
+    templates = responses(codebook, model, fs, step_duration, on_duration)
+    target_ids = rng.integers(n_objs, size=n_trials)
+    eeg = simulate(templates, target_ids, snr=snr, noise_kind=noise_kind, rng=rng)
+
+    steps = np.unique(np.linspace(n_steps / n_points, n_steps, n_points).round().astype(np.int64))
+    ends = steps * (templates.shape[-1] // n_steps)
+    accuracy = (decode(eeg, templates, ends) == target_ids).mean(axis=1)
+    trial_duration = steps * step_duration + inter_trial_duration
+    return {
+        'steps': steps,
+        'trial_duration': trial_duration,
+        'accuracy': accuracy,
+        'itr': itr(accuracy, n_objs, trial_duration),
+    }
+
+def evaluate_condition(codebooks: np.ndarray, **kwargs) -> dict:
+    """evaluate every codebook of a stack (n_codebooks, n_objs, n_steps) and average the curves"""
+    results = [evaluate(codebook, **kwargs) for codebook in codebooks]
+    return {key: np.mean([result[key] for result in results], axis=0) for key in results[0]}
+
+def rank(candidates: dict, **kwargs) -> list:
+    """(name, best ITR, result) for named codebook stacks, best first"""
+    ranked = []
+    for name, codebooks in candidates.items():
+        result = evaluate_condition(codebooks, **kwargs)
+        ranked.append((name, float(result['itr'].max()), result))
+    return sorted(ranked, key=lambda item: -item[1])
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Simulate template-matching decoding of the codebooks')
+    parser.add_argument('--n-trials', type=int, default=1000, help='simulated trials per codebook')
+    parser.add_argument('--snr', type=float, default=0.1, help='signal to noise power ratio of single trials')
+    parser.add_argument('--noise', type=str, default='white', choices=['white', 'pink'])
+    parser.add_argument('--erp-on-duration', type=float, default=0.1)
+    parser.add_argument('--erp-off-duration', type=float, default=0.15)
+    parser.add_argument('--refresh-rate', type=float, default=60, help='step rate of the c-VEP codes')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    common = dict(n_trials=args.n_trials, snr=args.snr, noise_kind=args.noise, rng=rng)
+    erp = dict(model='erp', step_duration=args.erp_on_duration + args.erp_off_duration, on_duration=args.erp_on_duration, **common)
+    cvep = dict(model='cvep', step_duration=1 / args.refresh_rate, on_duration=None, **common)
+    condition_3 = np.swapaxes(get_archive().load('condition_3'), -1, -2)
+    ranked = rank({'condition_1': load_condition('./codebooks/condition_1'), 'condition_2': load_condition('./codebooks/condition_2')}, **erp)
+    ranked += rank({'condition_3': condition_3[:1]}, **cvep)
+    for name, best_itr, result in sorted(ranked, key=lambda item: -item[1]):
+        print(f'{name}: best ITR {best_itr:.1f} bits/min')
+        for duration, accuracy, bits in zip(result['trial_duration'], result['accuracy'], result['itr']):
+            print(f'  {duration:6.2f} s  accuracy {accuracy:.3f}  ITR {bits:.1f}')
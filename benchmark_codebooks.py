@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import argparse
+import datetime
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+from generate_codebooks import gen_row, gen_codebook, exist_spatial_neighbors, compute_diag_neighbors, search_restarts
+from codebook_annealing import anneal_single_trial
+
+# Fixed seeds and layouts so numbers are comparable between commits. Every run is stored as JSON in
+# RESULTS_DIR and can be compared against an earlier one with --compare.
+RESULTS_DIR = './benchmarks'
+LAYOUTS = [
+    {'n_objs': 8, 'n_obj_highlights': 2, 'n_off_intervals': 3, 'n_min_highlights': 1},
+    {'n_objs': 16, 'n_obj_highlights': 2, 'n_off_intervals': 3, 'n_min_highlights': 1},
+    {'n_objs': 32, 'n_obj_highlights': 4, 'n_off_intervals': 3, 'n_min_highlights': 1},
+]
+
+
+def _rate(fn, min_duration: float) -> float:
+    """Calls per second of fn, repeated for at least min_duration seconds"""
+    n_calls = 0
+    start_time = time.perf_counter()
+    while True:
+        fn()
+        n_calls += 1
+        elapsed_time = time.perf_counter() - start_time
+        if elapsed_time >= min_duration:
+            return n_calls / elapsed_time
+
+def _peak_memory(fn) -> int:
+    """Peak traced Python allocation of one call in bytes"""
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def benchmark_layout(layout: dict, seed: int=42, min_duration: float=1.0, n_restarts: int=200, n_reps: int=12, zero_budget: float=30.0) -> dict:
+    rng = np.random.default_rng(seed)
+    n_objs = layout['n_objs']
+    codebook = gen_codebook(np.zeros((1, n_objs)), rng=rng, **layout)
+    trial = np.vstack([gen_codebook(np.zeros((1, n_objs)), rng=rng, **layout) for _ in range(n_reps)]).T
+    prev_rows = codebook[-layout['n_off_intervals']:]
+
+    results = {
+        'rows_per_s': _rate(lambda: gen_row(n_objs, prev_rows, layout['n_obj_highlights'], rng=rng), min_duration),
+        'codebooks_per_s': _rate(lambda: gen_codebook(np.zeros((1, n_objs)), rng=rng, **layout), min_duration),
+        'spatial_checks_per_s': _rate(lambda: exist_spatial_neighbors(codebook), min_duration),
+        'diag_scores_per_s': _rate(lambda: compute_diag_neighbors(trial), min_duration),
+    }
+
+    # Restart search with a fixed budget: best score and duration
+    rng = np.random.default_rng(seed)
+    start_time = time.perf_counter()
+    _, best_diag_val = search_restarts(n_restarts, n_reps, rng=rng, progress=False, **layout)
+    results['search_best_diag'] = int(best_diag_val)
+    results['search_time_s'] = time.perf_counter() - start_time
+
+    # Random restarts practically never reach zero, annealing does and stops there. None if it did not
+    # within zero_budget seconds.
+    start_time = time.perf_counter()
+    trial = anneal_single_trial(n_reps, time_budget=zero_budget, rng=np.random.default_rng(seed), **layout)
+    elapsed_time = time.perf_counter() - start_time
+    results['anneal_best_diag'] = compute_diag_neighbors(trial)
+    results['time_to_zero_diag_s'] = elapsed_time if results['anneal_best_diag'] == 0 else None
+
+    rng = np.random.default_rng(seed)
+    results['restarts_per_s'] = _rate(lambda: search_restarts(1, n_reps, rng=rng, progress=False, **layout), min_duration)
+    results['peak_memory_bytes'] = _peak_memory(lambda: search_restarts(10, n_reps, rng=np.random.default_rng(seed), progress=False, **layout))
+    return results
+
+def run(seed: int=42, min_duration: float=1.0, n_restarts: int=200, zero_budget: float=30.0) -> dict:
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    report = {
+        'created': datetime.datetime.now().isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'seed': seed,
+        'layouts': [],
+    }
+    for layout in LAYOUTS:
+        print(f'Benchmarking {layout}')
+        report['layouts'].append({'layout': layout, 'results': benchmark_layout(layout, seed, min_duration, n_restarts, zero_budget=zero_budget)})
+    return report
+
+def compare(report: dict, baseline: dict) -> None:
+    """Print the ratio of every metric against a baseline run (> 1 is faster for rates)"""
+    for current, previous in zip(report['layouts'], baseline['layouts']):
+        print(f"n_objs={current['layout']['n_objs']} vs {baseline.get('commit')}")
+        for key, value in current['results'].items():
+            old_value = previous['results'].get(key)
+            if value is None or not old_value:
+                print(f'  {key}: {value} (baseline {old_value})')
+            else:
+                print(f'  {key}: {value:.4g} (baseline {old_value:.4g}, x{value / old_value:.2f})')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the codebook generation hot paths')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--min-duration', type=float, default=1.0, help='seconds per throughput measurement')
+    parser.add_argument('--n-restarts', type=int, default=200, help='restart budget for the search benchmark')
+    parser.add_argument('--zero-budget', type=float, default=30.0, help='seconds of annealing to reach a zero-diagonal trial')
+    parser.add_argument('--compare', type=str, default=None, help='earlier result file to compare against')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = run(seed=args.seed, min_duration=args.min_duration, n_restarts=args.n_restarts, zero_budget=args.zero_budget)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    fpath = os.path.join(RESULTS_DIR, datetime.datetime.now().strftime('bench_%Y-%m-%d_%H-%M-%S.json'))
+    with open(fpath, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report['layouts'], indent=2))
+    print(f'Saved to {fpath}')
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
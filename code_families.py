@@ -0,0 +1,98 @@
+import numpy as np
+from scipy.signal import max_len_seq
+from codebook_metrics import circular_autocorrelation
+
+# Polynomials are given like in gen_seq.ipynb (pyntbci): [1, 0, 0, 0, 0, 1] is 1 + x + x^6.
+# Families are (n_codes, n_bits) uint8, the layout load_codebooks_block_3 reads from ./codebooks/condition_3.
+POLY_61 = [1, 0, 0, 0, 0, 1]
+POLY_6521 = [1, 1, 0, 0, 1, 1]
+
+
+def m_sequence(poly: list=POLY_61, seed: list=None) -> np.ndarray:
+    """Maximum length sequence of 2**len(poly) - 1 bits.
+
+    Runs on scipy's LFSR and matches pyntbci.stimulus.make_m_sequence bit for bit.
+    """
+    poly = np.asarray(poly)
+    n = poly.size
+    assert poly[-1] == 1, 'The polynomial must contain x^n'
+    taps = [n - 1 - k for k in np.flatnonzero(poly[:-1])]
+    state = np.ones(n) if seed is None else np.asarray(seed)[::-1]
+    sequence, _ = max_len_seq(n, state=state, taps=taps)
+    # scipy emits the seed bits first, pyntbci the first feedback bit
+    return np.roll(sequence, -n).astype(np.uint8)
+
+def circular_shifts(code: np.ndarray, direction: int=1) -> np.ndarray:
+    """All circular shifts of a code as one read-only strided view: (n_bits, n_bits).
+
+    Row i equals np.roll(code, direction * i) for direction 1 or -1.
+    """
+    code = np.asarray(code)
+    n = code.size
+    doubled = np.concatenate([code, code])
+    step = doubled.strides[0]
+    if direction == 1:
+        return np.lib.stride_tricks.as_strided(doubled[n:], shape=(n, n), strides=(-step, step), writeable=False)
+    elif direction == -1:
+        return np.lib.stride_tricks.as_strided(doubled, shape=(n, n), strides=(step, step), writeable=False)
+    raise ValueError(f'direction must be 1 or -1: {direction}')
+
+def mseq_shift_family(poly: list=POLY_61, n_codes: int=None, spacing: int=1, seed: list=None) -> np.ndarray:
+    """Shifted m-sequences, code i is the m-sequence rolled by i * spacing"""
+    shifts = circular_shifts(m_sequence(poly, seed))
+    if n_codes is None:
+        n_codes = shifts.shape[0] // spacing
+    return shifts[::spacing][:n_codes]
+
+def gold_codes(poly1: list=POLY_61, poly2: list=POLY_6521, seed1: list=None, seed2: list=None) -> np.ndarray:
+    """Gold codes of a preferred pair: m-sequence 1 xor every shift of m-sequence 2"""
+    return m_sequence(poly1, seed1) ^ circular_shifts(m_sequence(poly2, seed2), direction=-1)
+
+def modulate(codes: np.ndarray) -> np.ndarray:
+    """Xor with a double frequency bit-clock, doubles the number of bits"""
+    codes = np.repeat(codes, 2, axis=-1)
+    clock = np.zeros(codes.shape[-1], dtype=codes.dtype)
+    clock[::2] = 1
+    return codes ^ clock
+
+def circular_cross_correlation(codes: np.ndarray) -> np.ndarray:
+    """Normalized circular cross-correlation of bipolar codes for every pair and lag via FFT.
+
+    Returns (n_codes, n_codes, n_bits), entry [i, j, lag] correlates code i with code j delayed by lag.
+    """
+    x = 2 * (np.asarray(codes, dtype=float) == 1) - 1
+    n_bits = x.shape[-1]
+    spectrum = np.fft.rfft(x, axis=-1)
+    return np.fft.irfft(spectrum[:, None, :] * np.conj(spectrum[None, :, :]), n=n_bits, axis=-1) / n_bits
+
+def score_family(codes: np.ndarray, max_lag: int=None) -> dict:
+    """Worst auto-correlation sidelobe and worst cross-correlation between different codes.
+
+    Only lags up to max_lag in both directions are considered for the cross-correlation, which is what
+    matters for shifted m-sequences whose shifts are further apart than the response length.
+    """
+    corrs = np.abs(circular_cross_correlation(codes))
+    n_codes, n_bits = corrs.shape[0], corrs.shape[-1]
+    if max_lag is not None:
+        lags = np.r_[0:max_lag + 1, n_bits - max_lag:n_bits]
+        corrs = corrs[..., np.unique(lags % n_bits)]
+    off_diagonal = ~np.eye(n_codes, dtype=bool)
+    return {
+        'max_sidelobe': np.abs(circular_autocorrelation(codes)[:, 1:]).max(),
+        'max_cross_corr': corrs[off_diagonal].max() if n_codes > 1 else 0.0,
+    }
+
+def save_code_family(codes: np.ndarray, fpath: str) -> None:
+    np.save(fpath, np.ascontiguousarray(codes, dtype=np.uint8))
+
+def main(path: str='./codebooks/condition_3'):
+    """Regenerate the condition 3 files originally made in gen_seq.ipynb"""
+    save_code_family(mseq_shift_family(POLY_61), f'{path}/mseq_61_shift.npy')
+    save_code_family(mseq_shift_family(POLY_61, n_codes=8, spacing=8), f'{path}/mseq_61_shift_8.npy')
+    codes = gold_codes(POLY_61, POLY_6521)
+    save_code_family(codes, f'{path}/gold_61_6521.npy')
+    save_code_family(modulate(codes), f'{path}/mgold_61_6521.npy')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import time
+import numpy as np
+from codebook_solver import get_solver
+from codebook_bits import pack_codebook, unpack_codebook, count_diag_neighbors
+
+
+def _draw_block(solver, rng: np.random.Generator) -> np.ndarray:
+    """One random bit-packed block of the shortest length, drawn on demand"""
+    return pack_codebook(solver.draw(rng=rng))
+
+def _initial_blocks(solver, n_reps: int, rng: np.random.Generator) -> np.ndarray:
+    """Random chain of blocks where each block starts with objects the previous one did not end with"""
+    first = _draw_block(solver, rng)
+    blocks = np.empty((n_reps, len(first)), dtype=first.dtype)
+    blocks[0] = first
+    for i in range(1, n_reps):
+        block = _draw_block(solver, rng)
+        while block[0] & blocks[i - 1, -1]:
+            block = _draw_block(solver, rng)
+        blocks[i] = block
+    return blocks
+
+def _boundaries_ok(blocks: np.ndarray) -> bool:
+    return not (blocks[:-1, -1] & blocks[1:, 0]).any()
+
+def _row_order_ok(block: np.ndarray, n_objs: int, n_off_intervals: int, n_min_highlights: int) -> bool:
+    """Constraints a row swap can break: the refractory window, and that the block only completes on its last row"""
+    for d in range(1, n_off_intervals + 1):
+        if (block[d:] & block[:-d]).any():
+            return False
+    return unpack_codebook(block[:-1], n_objs).sum(axis=0).min() < n_min_highlights
+
+def anneal_single_trial(
+        n_reps: int=12, time_budget: float=5.0, n_objs: int=8, n_obj_highlights: int=2, n_off_intervals: int=3, n_min_highlights: int=1,
+        t_start: float=2.0, t_end: float=0.05, init_trial: np.ndarray=None, rng: np.random.Generator=None
+    ) -> np.ndarray:
+    """Simulated annealing alternative to generate_single_trial.
+
+    Minimizes compute_diag_neighbors over trials made of n_reps gen_codebook blocks. Moves are
+    row swaps inside a block, block swaps and block replacements, and every candidate keeps the
+    gen_codebook constraints plus the block boundary rule of generate_single_trial.
+    Anytime: returns the best trial (n_objs, n_steps) found once time_budget seconds ran out
+    or a zero-diagonal trial was reached. The budget includes the setup, blocks are bit-packed
+    and drawn on demand with CodebookSolver.draw.
+    """
+    start_time = time.perf_counter()
+    if rng is None:
+        rng = np.random.default_rng()
+    solver = get_solver(n_objs, n_obj_highlights, n_off_intervals, n_min_highlights)
+
+    if init_trial is None:
+        blocks = _initial_blocks(solver, n_reps, rng)
+    else:
+        blocks = pack_codebook(np.asarray(init_trial).T).reshape(n_reps, -1)
+    block_len = blocks.shape[1]
+    energy = count_diag_neighbors(blocks.ravel())
+    best_blocks, best_energy = blocks.copy(), energy
+
+    while best_energy > 0:
+        progress = (time.perf_counter() - start_time) / time_budget
+        if progress >= 1:
+            break
+        temperature = t_start * (t_end / t_start) ** progress
+
+        candidate = blocks.copy()
+        i = rng.integers(n_reps)
+        move = rng.integers(3)
+        if move == 0:
+            a, b = rng.choice(block_len, size=2, replace=False)
+            candidate[i, [a, b]] = candidate[i, [b, a]]
+            if not _row_order_ok(candidate[i], n_objs, n_off_intervals, n_min_highlights):
+                continue
+        elif move == 1:
+            j = rng.integers(n_reps)
+            candidate[[i, j]] = candidate[[j, i]]
+        else:
+            candidate[i] = _draw_block(solver, rng)
+        if not _boundaries_ok(candidate):
+            continue
+
+        candidate_energy = count_diag_neighbors(candidate.ravel())
+        delta = candidate_energy - energy
+        if delta <= 0 or rng.random() < np.exp(-delta / temperature):
+            blocks, energy = candidate, candidate_energy
+            if energy < best_energy:
+                best_blocks, best_energy = blocks.copy(), energy
+
+    print('Lest diag neighbors:', best_energy)
+    return unpack_codebook(best_blocks.ravel(), n_objs).T
@@ -0,0 +1,146 @@
+import os
+import glob
+import json
+import datetime
+import logging
+from functools import lru_cache
+import numpy as np
+from utils import load_codebook
+
+# Layout: MAGIC | uint64 header length | JSON header | arrays, each aligned to ALIGNMENT bytes.
+# The header indexes every entry by key with its dtype, shape, byte offset and metadata, so entries
+# are memory-mapped on first access and nothing else is read from disk. An alias entry points at
+# the bytes of another entry ('alias_of') instead of storing them again.
+MAGIC = b'CBARCHV1'
+ALIGNMENT = 64
+ARCHIVE_PATH = './codebooks/codebooks.cbar'
+
+
+def _align(n: int) -> int:
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+def write_archive(fpath: str, arrays: dict, metadata: dict=None, aliases: dict=None) -> None:
+    """Write {key: array} with optional {key: dict} metadata and {alias: key} aliases into a single archive file"""
+    metadata = metadata or {}
+    arrays = {key: np.ascontiguousarray(array) for key, array in arrays.items()}
+    index = {}
+    offset = 0
+    for key, array in arrays.items():
+        index[key] = {
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+            'offset': offset,
+            'metadata': metadata.get(key, {}),
+        }
+        offset = _align(offset + array.nbytes)
+    for alias, key in (aliases or {}).items():
+        index[alias] = {**index[key], 'alias_of': key}
+    header = json.dumps({'created': datetime.datetime.now().isoformat(), 'index': index}).encode()
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    with open(fpath, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for key, array in arrays.items():
+            f.seek(data_start + index[key]['offset'])
+            f.write(array.tobytes())
+    logging.info(f'Codebook archive written: {fpath} ({len(index)} entries)')
+
+
+class CodebookArchive:
+    """Read side of the archive. Entries are np.memmap views created lazily and cached."""
+    def __init__(self, fpath: str=ARCHIVE_PATH):
+        self.fpath = fpath
+        with open(fpath, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'Not a codebook archive: {fpath}')
+            header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_len))
+        self.created = header['created']
+        self.index = header['index']
+        self._data_start = _align(len(MAGIC) + 8 + header_len)
+        self._arrays = {}
+        self._repeated = {}  # Tiled cyclic codes, built once per stored entry
+
+    def keys(self) -> list:
+        return list(self.index.keys())
+
+    def metadata(self, key: str) -> dict:
+        return self.index[key]['metadata']
+
+    def array(self, key: str) -> np.ndarray:
+        key = self.index[key].get('alias_of', key)
+        if key not in self._arrays:
+            entry = self.index[key]
+            self._arrays[key] = np.memmap(
+                self.fpath, dtype=np.dtype(entry['dtype']), mode='r',
+                offset=self._data_start + entry['offset'], shape=tuple(entry['shape'])
+            )
+        return self._arrays[key]
+
+    def get(self, key: str, run_id: int) -> np.ndarray:
+        """Codebook of one run, (n_steps, n_objs)"""
+        return self.array(key)[run_id]
+
+    def load(self, key: str) -> np.ndarray:
+        """All runs of a condition, same layout as the utils.load_codebooks_block_* loaders"""
+        array = self.array(key)
+        n_reps = self.metadata(key).get('n_reps')
+        if n_reps is None:
+            return array
+        # Cyclic codes are stored once and repeated for the trial length. All runs are read-only
+        # broadcast views of that single repeated array.
+        n_objs = self.metadata(key)['n_objs']
+        stored_key = self.index[key].get('alias_of', key)
+        if stored_key not in self._repeated:
+            repeated = np.tile(array, (n_reps,) + (1,) * (array.ndim - 1))
+            repeated.flags.writeable = False
+            self._repeated[stored_key] = repeated
+        repeated = self._repeated[stored_key]
+        return np.broadcast_to(repeated, (n_objs,) + repeated.shape)
+
+
+@lru_cache(maxsize=None)
+def get_archive(fpath: str=ARCHIVE_PATH) -> CodebookArchive:
+    return CodebookArchive(fpath)
+
+def build_archive(
+        fpath: str=ARCHIVE_PATH, path: str='./codebooks', n_reps: int=12, n_objs: int=8,
+        condition_3_path: str=None, generation: dict=None
+    ) -> None:
+    """Pack the condition_* .npy files into one archive.
+
+    condition_1/2 become (n_runs, n_steps, n_objs) arrays. Every condition_3 code family is stored
+    once as (n_bits, n_codes) and tiled n_reps times on load, condition_3 is mseq_61_shift_8.
+    The families are read from condition_3_path (default {path}/condition_3), none found is an error.
+    generation maps a condition to how it was generated (seed, constraints, ...), stored in its metadata.
+    """
+    generation = generation or {}
+    if condition_3_path is None:
+        condition_3_path = f'{path}/condition_3'
+    arrays, metadata, aliases = {}, {}, {}
+    for condition in ['condition_1', 'condition_2']:
+        fpaths = sorted(glob.glob(f'{path}/{condition}/codebook_obj_*.npy'))
+        codebooks = [load_codebook(fpath) for fpath in fpaths]
+        shapes = {codebook.shape for codebook in codebooks}
+        if len(shapes) != 1:
+            raise ValueError(f'{condition} codebooks disagree on shape: {shapes}')
+        arrays[condition] = np.array(codebooks)
+        metadata[condition] = {'sources': [os.path.basename(fpath) for fpath in fpaths], **generation.get(condition, {})}
+    fpaths_3 = sorted(glob.glob(f'{condition_3_path}/*.npy'))
+    if not fpaths_3:
+        raise ValueError(f'No condition_3 code families in {condition_3_path}')
+    for fpath_3 in fpaths_3:
+        name = os.path.splitext(os.path.basename(fpath_3))[0]
+        arrays[f'condition_3/{name}'] = load_codebook(fpath_3)
+        metadata[f'condition_3/{name}'] = {
+            'sources': [os.path.basename(fpath_3)], 'n_reps': n_reps, 'n_objs': n_objs, **generation.get('condition_3', {})
+        }
+    if 'condition_3/mseq_61_shift_8' in arrays:
+        aliases['condition_3'] = 'condition_3/mseq_61_shift_8'
+    write_archive(fpath, arrays, metadata, aliases)
+
+
+if __name__ == '__main__':
+    build_archive()
@@ -0,0 +1,53 @@
+import numpy as np
+
+# Number of set bits for every uint8 value
+_POPCOUNT_8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def packed_dtype(n_objs: int) -> type:
+    """Smallest unsigned int that holds one bit per object"""
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if n_objs <= np.dtype(dtype).itemsize * 8:
+            return dtype
+    raise ValueError(f'Cannot bit-pack {n_objs} objects, at most 64 are supported')
+
+def pack_codebook(codebook: np.ndarray) -> np.ndarray:
+    """(..., n_steps, n_objs) 0/1 codebook -> (..., n_steps) bitmasks. Bit j is object j."""
+    codebook = np.asarray(codebook)
+    n_objs = codebook.shape[-1]
+    dtype = packed_dtype(n_objs)
+    weights = np.left_shift(dtype(1), np.arange(n_objs, dtype=dtype))
+    return np.bitwise_or.reduce(np.where(codebook == 1, weights, dtype(0)), axis=-1)
+
+def unpack_codebook(packed: np.ndarray, n_objs: int) -> np.ndarray:
+    """(..., n_steps) bitmasks -> (..., n_steps, n_objs) float codebook, like the generator output"""
+    packed = np.asarray(packed)
+    bits = np.arange(n_objs, dtype=packed.dtype)
+    return ((packed[..., None] >> bits) & packed.dtype.type(1)).astype(float)
+
+def popcount(packed: np.ndarray) -> np.ndarray:
+    """Number of highlighted objects in every step"""
+    packed = np.ascontiguousarray(packed)
+    counts = _POPCOUNT_8[packed.view(np.uint8)].reshape(packed.shape + (packed.dtype.itemsize,))
+    return counts.sum(axis=-1, dtype=np.int64)
+
+def object_highlights(packed: np.ndarray, n_objs: int) -> np.ndarray:
+    """Number of highlights per object, summed over the step axis"""
+    return unpack_codebook(packed, n_objs).sum(axis=-2).astype(np.int64)
+
+def has_spatial_neighbors(packed: np.ndarray) -> bool:
+    """True if any step highlights two neighboring objects"""
+    packed = np.asarray(packed)
+    return bool((packed & (packed >> packed.dtype.type(1))).any())
+
+def count_diag_neighbors(packed: np.ndarray) -> int:
+    """Bitwise version of generate_codebooks.compute_diag_neighbors with a 3x3 kernel.
+
+    Counts diagonal and anti-diagonal runs of three highlights over three consecutive steps.
+    """
+    packed = np.asarray(packed)
+    one, two = packed.dtype.type(1), packed.dtype.type(2)
+    prev, cur, nxt = packed[..., :-2], packed[..., 1:-1], packed[..., 2:]
+    down = prev & (cur >> one) & (nxt >> two)
+    up = (prev >> two) & (cur >> one) & nxt
+    return int(popcount(down).sum() + popcount(up).sum())
@@ -0,0 +1,62 @@
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+
+CACHE_DIR = './codebook_cache'
+
+
+class CodebookCache:
+    """Content-addressed on-disk cache of generated codebooks.
+
+    Entries are .npy files named by a hash of the generation parameters. File mtimes double as
+    access times, so the least recently used entries are evicted once the cache exceeds max_bytes.
+    """
+    def __init__(self, path: str=CACHE_DIR, max_bytes: int=256 * 2**20):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, **params) -> str:
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def _fpath(self, key: str) -> str:
+        return os.path.join(self.path, f'{key}.npy')
+
+    def get(self, key: str) -> np.ndarray:
+        """Cached array or None. A hit marks the entry as recently used."""
+        fpath = self._fpath(key)
+        try:
+            codebook = np.load(fpath)
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(fpath)
+        return codebook
+
+    def put(self, key: str, codebook: np.ndarray) -> None:
+        fpath = self._fpath(key)
+        tmp_fpath = fpath + '.tmp'
+        with open(tmp_fpath, 'wb') as f:
+            np.save(f, codebook)
+        os.replace(tmp_fpath, fpath)
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npy'):
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.path, name))
+            total_bytes -= size
+            logging.info(f'Evicted cached codebook {name}')
+
+    def clear(self) -> None:
+        for name in os.listdir(self.path):
+            if name.endswith('.npy'):
+                os.remove(os.path.join(self.path, name))
@@ -0,0 +1,88 @@
+import glob
+import numpy as np
+
+# All metrics take codebooks as (..., n_objs, n_steps), the layout of the .npy files and of
+# generate_single_trial, so a stack of candidates (n_candidates, n_objs, n_steps) is scored at once.
+
+
+def load_condition(path: str='./codebooks/condition_2') -> np.ndarray:
+    """Stack the codebook_obj_*.npy files of a condition into (n_codebooks, n_objs, n_steps)"""
+    fpaths = sorted(glob.glob(f'{path}/codebook_obj_*.npy'))
+    return np.array([np.load(fpath) for fpath in fpaths])
+
+def flash_counts(codebooks: np.ndarray) -> np.ndarray:
+    """Number of flashes per object: (..., n_objs)"""
+    return (np.asarray(codebooks) == 1).sum(axis=-1)
+
+def cross_correlation(codebooks: np.ndarray) -> np.ndarray:
+    """Pearson correlation between every pair of object sequences: (..., n_objs, n_objs).
+    Objects that never change get nan."""
+    x = np.asarray(codebooks, dtype=float)
+    x = x - x.mean(axis=-1, keepdims=True)
+    norms = np.sqrt((x ** 2).sum(axis=-1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (x @ np.swapaxes(x, -1, -2)) / (norms[..., :, None] * norms[..., None, :])
+
+def max_cross_correlation(codebooks: np.ndarray) -> np.ndarray:
+    """Largest off-diagonal absolute correlation: (...,)"""
+    corrs = np.abs(cross_correlation(codebooks))
+    n_objs = corrs.shape[-1]
+    corrs[..., np.arange(n_objs), np.arange(n_objs)] = np.nan
+    return np.nanmax(corrs, axis=(-2, -1))
+
+def hamming_distances(codebooks: np.ndarray) -> np.ndarray:
+    """Number of differing steps between every pair of objects: (..., n_objs, n_objs)"""
+    x = (np.asarray(codebooks) == 1).astype(np.int64)
+    return x @ np.swapaxes(1 - x, -1, -2) + (1 - x) @ np.swapaxes(x, -1, -2)
+
+def min_hamming_distance(codebooks: np.ndarray) -> np.ndarray:
+    """Smallest Hamming distance between two different objects: (...,)"""
+    dists = hamming_distances(codebooks).astype(float)
+    n_objs = dists.shape[-1]
+    dists[..., np.arange(n_objs), np.arange(n_objs)] = np.inf
+    return dists.min(axis=(-2, -1)).astype(np.int64)
+
+def target_interval_histogram(codebooks: np.ndarray) -> np.ndarray:
+    """Histogram of steps between consecutive flashes of the same object: (..., n_objs, n_steps).
+    Entry [..., j, k] counts how often object j flashed again k steps after a flash."""
+    x = np.asarray(codebooks) == 1
+    n_steps = x.shape[-1]
+    flat = x.reshape(-1, n_steps)
+    seq_idc, step_idc = np.nonzero(flat)
+    # Consecutive flashes of the same sequence are neighbors in the row-major nonzero order
+    same_seq = seq_idc[1:] == seq_idc[:-1]
+    intervals = np.diff(step_idc)[same_seq]
+    bins = seq_idc[1:][same_seq] * n_steps + intervals
+    hist = np.bincount(bins, minlength=flat.shape[0] * n_steps)
+    return hist.reshape(x.shape)
+
+def min_target_interval(codebooks: np.ndarray) -> np.ndarray:
+    """Shortest gap between two flashes of an object, n_steps if no object flashes twice: (...,)"""
+    hist = target_interval_histogram(codebooks)
+    n_steps = hist.shape[-1]
+    has_interval = hist.sum(axis=-2) > 0
+    steps = np.where(has_interval, np.arange(n_steps), n_steps)
+    return steps.min(axis=-1)
+
+def circular_autocorrelation(codes: np.ndarray) -> np.ndarray:
+    """Normalized circular auto-correlation of bipolar (+1/-1) codes via FFT: (..., n_objs, n_steps).
+    Lag 0 is 1, an m-sequence gives -1/n_steps at every other lag."""
+    x = 2 * (np.asarray(codes, dtype=float) == 1) - 1
+    n_steps = x.shape[-1]
+    spectrum = np.fft.rfft(x, axis=-1)
+    return np.fft.irfft(spectrum * np.conj(spectrum), n=n_steps, axis=-1) / n_steps
+
+def max_sidelobe(codes: np.ndarray) -> np.ndarray:
+    """Largest absolute auto-correlation away from lag 0 per code: (..., n_objs)"""
+    return np.abs(circular_autocorrelation(codes)[..., 1:]).max(axis=-1)
+
+def summarize(codebooks: np.ndarray) -> dict:
+    """Per-codebook summary used to rank candidates, every value has shape (...,)"""
+    counts = flash_counts(codebooks)
+    return {
+        'min_flashes': counts.min(axis=-1),
+        'max_flashes': counts.max(axis=-1),
+        'min_hamming': min_hamming_distance(codebooks),
+        'max_cross_corr': max_cross_correlation(codebooks),
+        'min_target_interval': min_target_interval(codebooks),
+    }
@@ -0,0 +1,197 @@
+import itertools
+from functools import lru_cache
+import numpy as np
+
+
+class CodebookSolver:
+    """Depth-first solver for the gen_codebook constraints.
+
+    A codebook is a sequence of rows where every row highlights n_obj_highlights
+    non-adjacent objects, no object is highlighted again within n_off_intervals rows,
+    and generation stops as soon as every object reached n_min_highlights.
+    Rows are kept as int bitmasks (bit j == object j) while searching.
+
+    draw() returns a random solution within a bounded number of search steps. sample() is exactly
+    uniform but needs the solution counts, whose memo grows exponentially with n_objs; it refuses once
+    the memo passes max_states (8-9 objects with the default).
+    """
+    def __init__(self, n_objs: int, n_obj_highlights: int, n_off_intervals: int, n_min_highlights: int, max_rows: int=None, max_states: int=50000):
+        assert n_off_intervals < n_objs // n_obj_highlights
+        self.n_objs = n_objs
+        self.n_obj_highlights = n_obj_highlights
+        self.n_off_intervals = n_off_intervals
+        self.n_min_highlights = n_min_highlights
+        # Shortest possible codebook by default. Without a bound, sequences that keep skipping an object never end.
+        self.max_rows = max_rows or max(1, -(-n_objs * n_min_highlights // n_obj_highlights))
+
+        # All non-adjacent rows in lexicographic order of their highlighted indices
+        self.rows = []
+        for idc in itertools.combinations(range(n_objs), n_obj_highlights):
+            if 1 not in np.diff(idc):
+                self.rows.append(sum(1 << i for i in idc))
+        self.max_states = max_states
+        self._n_completions = {}
+
+    def _initial_state(self, init_codebook: np.ndarray=None):
+        window = [0] * self.n_off_intervals
+        if init_codebook is not None and self.n_off_intervals > 0:
+            for row in init_codebook[-self.n_off_intervals:]:
+                window.append(self.row_to_mask(row))
+        window = tuple(window[len(window) - self.n_off_intervals:])
+        return window, (0,) * self.n_objs
+
+    def row_to_mask(self, row: np.ndarray) -> int:
+        return sum(1 << int(i) for i in np.flatnonzero(np.asarray(row) == 1))
+
+    def mask_to_row(self, mask: int) -> np.ndarray:
+        return ((mask >> np.arange(self.n_objs)) & 1).astype(float)
+
+    def _is_done(self, counts: tuple) -> bool:
+        return min(counts) >= self.n_min_highlights
+
+    def _is_feasible(self, window: tuple, counts: tuple, rows_left: int) -> bool:
+        """Cheap lower bound on the rows still needed. Prunes branches that cannot finish in time."""
+        deficits = [self.n_min_highlights - c for c in counts]
+        if sum(d for d in deficits if d > 0) > rows_left * self.n_obj_highlights:
+            return False
+        for j, deficit in enumerate(deficits):
+            if deficit <= 0:
+                continue
+            # Object j has to leave the refractory window first, then needs n_off_intervals gaps between highlights
+            wait = 0
+            for age, mask in enumerate(reversed(window)):
+                if mask >> j & 1:
+                    wait = self.n_off_intervals - age
+                    break
+            if wait + (deficit - 1) * (self.n_off_intervals + 1) + 1 > rows_left:
+                return False
+        return True
+
+    def _children(self, window: tuple, counts: tuple):
+        blocked = 0
+        for mask in window:
+            blocked |= mask
+        for mask in self.rows:
+            if mask & blocked:
+                continue
+            new_window = (window + (mask,))[1:] if self.n_off_intervals > 0 else window
+            new_counts = tuple(min(c + (mask >> j & 1), self.n_min_highlights) for j, c in enumerate(counts))
+            yield mask, new_window, new_counts
+
+    def _count(self, window: tuple, counts: tuple, depth: int) -> int:
+        """Number of solutions below a state, memoized on (window, capped counts, depth)."""
+        key = (window, counts, depth)
+        if key in self._n_completions:
+            return self._n_completions[key]
+        if len(self._n_completions) >= self.max_states:
+            self._n_completions.clear()
+            raise ValueError(
+                f'Counting the codebooks of {self.n_objs} objects needs more than max_states={self.max_states} states, use draw() instead'
+            )
+        n = 0
+        rows_left = self.max_rows - depth
+        if rows_left > 0 and self._is_feasible(window, counts, rows_left):
+            for _, new_window, new_counts in self._children(window, counts):
+                if self._is_done(new_counts):
+                    n += 1
+                else:
+                    n += self._count(new_window, new_counts, depth + 1)
+        self._n_completions[key] = n
+        return n
+
+    def solutions(self, init_codebook: np.ndarray=None):
+        """Yield every codebook in lexicographic row order."""
+        window, counts = self._initial_state(init_codebook)
+        stack = [(window, counts, [])]
+        while stack:
+            window, counts, masks = stack.pop()
+            if window is None:
+                yield np.array([self.mask_to_row(mask) for mask in masks])
+                continue
+            rows_left = self.max_rows - len(masks)
+            if rows_left <= 0 or not self._is_feasible(window, counts, rows_left):
+                continue
+            children = list(self._children(window, counts))
+            # Push in reverse so children pop in lexicographic order. Finished codebooks are marked with window=None.
+            for mask, new_window, new_counts in reversed(children):
+                stack.append((None if self._is_done(new_counts) else new_window, new_counts, masks + [mask]))
+
+    def draw(self, init_codebook: np.ndarray=None, rng: np.random.Generator=None, max_nodes: int=100000) -> np.ndarray:
+        """Draw one codebook by a depth-first search with the children in random order.
+
+        Not exactly uniform, but needs no solution counts: at most max_nodes states are expanded.
+        Children are visited lazily, only the rows on the search path get their counts updated.
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        window, counts = self._initial_state(init_codebook)
+        stack = [(window, counts, [], None)]
+        n_nodes = 0
+        while stack:
+            window, counts, masks, children = stack[-1]
+            if children is None:
+                n_nodes += 1
+                if n_nodes > max_nodes:
+                    raise ValueError(f'No codebook found within max_nodes={max_nodes} search steps')
+                rows_left = self.max_rows - len(masks)
+                if rows_left <= 0 or not self._is_feasible(window, counts, rows_left):
+                    stack.pop()
+                    continue
+                blocked = 0
+                for mask in window:
+                    blocked |= mask
+                allowed = [mask for mask in self.rows if not mask & blocked]
+                children = iter([allowed[i] for i in rng.permutation(len(allowed))])
+                stack[-1] = (window, counts, masks, children)
+            mask = next(children, None)
+            if mask is None:
+                stack.pop()
+                continue
+            new_window = (window + (mask,))[1:] if self.n_off_intervals > 0 else window
+            new_counts = tuple(min(c + (mask >> j & 1), self.n_min_highlights) for j, c in enumerate(counts))
+            if self._is_done(new_counts):
+                return np.array([self.mask_to_row(mask) for mask in masks + [mask]])
+            stack.append((new_window, new_counts, masks + [mask], None))
+        raise ValueError(f'No codebook satisfies the constraints within {self.max_rows} rows')
+
+    def _root_count(self, window: tuple, counts: tuple) -> int:
+        """_count of a whole codebook. States left over from other init windows are dropped if they fill the memo."""
+        had_states = len(self._n_completions) > 0
+        try:
+            return self._count(window, counts, 0)
+        except ValueError:
+            if not had_states:
+                raise
+            return self._count(window, counts, 0)
+
+    def count(self, init_codebook: np.ndarray=None) -> int:
+        window, counts = self._initial_state(init_codebook)
+        return self._root_count(window, counts)
+
+    def sample(self, init_codebook: np.ndarray=None, rng: np.random.Generator=None) -> np.ndarray:
+        """Draw one codebook uniformly over all solutions.
+
+        Needs the exact solution counts, which grow exponentially with n_objs: raises ValueError once
+        they need more than max_states memo entries (about 9 objects). Use draw() for larger layouts.
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        window, counts = self._initial_state(init_codebook)
+        if self._root_count(window, counts) == 0:
+            raise ValueError(f'No codebook satisfies the constraints within {self.max_rows} rows')
+        masks = []
+        while True:
+            children = list(self._children(window, counts))
+            weights = np.array([
+                1 if self._is_done(new_counts) else self._count(new_window, new_counts, len(masks) + 1)
+                for _, new_window, new_counts in children
+            ], dtype=float)
+            mask, window, counts = children[rng.choice(len(children), p=weights / weights.sum())]
+            masks.append(mask)
+            if self._is_done(counts):
+                return np.array([self.mask_to_row(mask) for mask in masks])
+
+
+@lru_cache(maxsize=None)
+def get_solver(n_objs: int, n_obj_highlights: int, n_off_intervals: int, n_min_highlights: int, max_rows: int=None) -> CodebookSolver:
+    return CodebookSolver(n_objs, n_obj_highlights, n_off_intervals, n_min_highlights, max_rows)
@@ -0,0 +1,47 @@
+from typing import List, NamedTuple
+import numpy as np
+from codebook_bits import pack_codebook
+
+MARKER_IDS = {
+    'non_target': 100,
+    'target': 110,
+    'trial_start': 200,
+    'trial_end': 210
+}
+
+
+class FramePlan(NamedTuple):
+    """Everything the timing loop of one trial needs, compiled before the trial starts.
+
+    The loop only indexes into these by step, nothing is converted or allocated while stimulating.
+    """
+    states: np.ndarray  # (n_steps,) packed device state, bit j is object j
+    markers: np.ndarray  # (n_steps,) marker pushed with every step
+    rows: List[List[int]]  # Per step object values as Python ints, for draw_boxes
+    is_target: List[bool]  # Per step whether the target is highlighted
+    marker_samples: List[List[int]]  # Per step ready-made push_sample argument
+    start_sample: List[int]
+    end_sample: List[int]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+
+def compile_trial(codebook: np.ndarray, target_id: int, trial_id: int, marker_ids: dict=MARKER_IDS, n_steps: int=None) -> FramePlan:
+    """Compile a (n_steps, n_objs) codebook, e.g. a read-only view from the archive, into a FramePlan"""
+    codebook = np.asarray(codebook)
+    if n_steps is not None:
+        codebook = codebook[:n_steps]
+    target_values = codebook[:, target_id]
+    if not np.isin(target_values, (0, 1)).all():
+        raise ValueError(f'Unknown target values: {np.unique(target_values)}')
+    markers = np.where(target_values == 1, marker_ids['target'], marker_ids['non_target']) + target_id
+    return FramePlan(
+        states=pack_codebook(codebook),
+        markers=markers,
+        rows=codebook.astype(np.int64).tolist(),
+        is_target=(target_values == 1).tolist(),
+        marker_samples=[[marker] for marker in markers.tolist()],
+        start_sample=[marker_ids['trial_start'] + trial_id],
+        end_sample=[marker_ids['trial_end'] + trial_id],
+    )
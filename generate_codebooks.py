@@ -1,64 +1,170 @@
+import os
+import json
+import hashlib
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
 import seaborn as sns
 import random
 from tqdm import tqdm
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from codebook_solver import get_solver
+from row_graph import get_row_graph
+from codebook_bits import pack_codebook, has_spatial_neighbors
+from codebook_archive import build_archive
+from render_codebooks import render_all
+from codebook_cache import CodebookCache, CACHE_DIR
+from layouts import row_layout, grid_layout, parse_grid, layout_key, has_adjacent_highlights, adjacent_pairs, count_neighbor_paths
 from scipy.signal import convolve2d
-from scipy.signal import max_len_seq
 import numpy as np
 
 
 random.seed(42)
 np.random.seed(42)
+RNG = np.random.default_rng(42)
+# Bump whenever a change to the search changes its output for the same seed, invalidates cached trials
+GENERATOR_VERSION = 1
+# The cVEP code families (condition 3) ship with the source tree
+CONDITION_3_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'codebooks', 'condition_3')
 
-def gen_row(n_objs: int, prev_rows: np.ndarray, n_highlights: int, n_tries: int=1000) -> np.ndarray:
-    # Add a row with minimal horizontal distance
-    used_idc = []
-    for prev_row in prev_rows:
-        used_idc += np.where(prev_row == 1)[0].tolist()
-    if len(used_idc) == n_objs:
+def gen_row(n_objs: int, prev_rows: np.ndarray, n_highlights: int, n_tries: int=1000, batch_size: int=32, rng: np.random.Generator=None, adjacency=None) -> np.ndarray:
+    # Add a row without neighboring highlights, j and j+1 unless a sparse adjacency (see layouts.py) is given
+    if rng is None:
+        rng = RNG
+    used_mask = (prev_rows == 1).any(axis=0) if len(prev_rows) else np.zeros(n_objs, dtype=bool)
+    if used_mask.all():
         return np.ones(n_objs) * 99
-    
-    idc = np.arange(n_objs)
-    idc = np.setdiff1d(idc, used_idc)
-    for _ in range(n_tries):
-        new_idc = np.sort(np.random.choice(idc, size=n_highlights, replace=False))
-        idc_diffs = np.abs(np.diff(new_idc))
-        row = np.zeros(n_objs)
-        row[new_idc] = 1
-        if 1 not in idc_diffs:    
+
+    idc = np.flatnonzero(~used_mask)
+    if idc.size < n_highlights:
+        raise ValueError(f'Cannot pick {n_highlights} highlights from {idc.size} free objects')
+    for start in range(0, n_tries, batch_size):
+        # Draw a batch of candidate rows at once: the smallest n_highlights of uniform noise are independent
+        # random subsets, argpartition finds them in linear time for large layouts
+        n_batch = min(batch_size, n_tries - start)
+        picks = np.argpartition(rng.random((n_batch, idc.size)), n_highlights - 1, axis=1)[:, :n_highlights]
+        new_idc = np.sort(idc[picks], axis=1)
+        if adjacency is None:
+            valid = ~(np.diff(new_idc, axis=1) == 1).any(axis=1)
+        else:
+            valid = ~adjacent_pairs(new_idc, adjacency)
+        if valid.any():
             break
-        # if i == n_tries - 1:
-        #     print('Warning: couldnt find horizontally spaced row!')
+    # Fall back to the last candidate (same as the old retry loop) if none is spaced
+    choice = np.argmax(valid) if valid.any() else n_batch - 1
+    row = np.zeros(n_objs)
+    row[new_idc[choice]] = 1
     return row
 
+def _check_stream_params(n_objs: int, n_obj_highlights: int, n_off_intervals: int) -> None:
+    # Same rule as gen_codebook: otherwise the refractory window can block every object and gen_row never succeeds
+    if not n_off_intervals < n_objs // n_obj_highlights:
+        raise ValueError(
+            f'n_off_intervals={n_off_intervals} must be smaller than n_objs // n_obj_highlights={n_objs // n_obj_highlights}'
+        )
 
+def iter_rows(n_objs: int, n_obj_highlights: int, n_off_intervals: int, prev_rows: np.ndarray=None, rng: np.random.Generator=None, adjacency=None):
+    """Endless stream of valid rows, continuing after prev_rows.
+
+    Only the last n_off_intervals rows are kept, in a preallocated ring buffer. Each yielded row is a
+    view into that buffer and is overwritten n_off_intervals rows later, copy it to keep it longer.
+    Raises ValueError right away if the refractory window can block every object.
+    """
+    _check_stream_params(n_objs, n_obj_highlights, n_off_intervals)
+    return _iter_rows(n_objs, n_obj_highlights, n_off_intervals, prev_rows, rng, adjacency)
+
+def _iter_rows(n_objs: int, n_obj_highlights: int, n_off_intervals: int, prev_rows: np.ndarray, rng: np.random.Generator, adjacency):
+    history = np.zeros((n_off_intervals, n_objs))
+    if prev_rows is not None and n_off_intervals > 0:
+        prev_rows = prev_rows[-n_off_intervals:]
+        history[n_off_intervals - len(prev_rows):] = prev_rows
+    if n_off_intervals == 0:
+        while True:
+            new_row = gen_row(n_objs, history, n_obj_highlights, rng=rng, adjacency=adjacency)
+            if 99 not in new_row:
+                yield new_row
+    # Row order within the window does not matter to gen_row, so the oldest slot is simply overwritten
+    slot = 0
+    while True:
+        new_row = gen_row(n_objs, history, n_obj_highlights, rng=rng, adjacency=adjacency)
+        if 99 in new_row:
+            continue
+        history[slot] = new_row
+        yield history[slot]
+        slot = (slot + 1) % n_off_intervals
 
-def gen_codebook(init_codebook: np.ndarray, n_objs, n_obj_highlights, n_off_intervals, n_min_highlights):
+def iter_blocks(
+        n_objs: int, n_obj_highlights: int, n_off_intervals: int, n_min_highlights: int,
+        init_codebook: np.ndarray=None, rng: np.random.Generator=None, adjacency=None
+    ):
+    """Endless stream of repetition blocks, every object highlighted n_min_highlights times per block.
+
+    Blocks are cut from one continuous row stream (iter_rows), so the refractory rule also holds across
+    block boundaries. Rows are written into a preallocated buffer that doubles when full, and each
+    yielded block is a view into it that the next block overwrites.
+    Raises ValueError right away if the refractory window can block every object.
+    """
+    _check_stream_params(n_objs, n_obj_highlights, n_off_intervals)
+    return _iter_blocks(n_objs, n_obj_highlights, n_off_intervals, n_min_highlights, init_codebook, rng, adjacency)
+
+def _iter_blocks(
+        n_objs: int, n_obj_highlights: int, n_off_intervals: int, n_min_highlights: int,
+        init_codebook: np.ndarray, rng: np.random.Generator, adjacency
+    ):
+    buffer = np.zeros((4 * n_objs, n_objs))
+    counts = np.zeros(n_objs)
+    n_rows = 0
+    for row in _iter_rows(n_objs, n_obj_highlights, n_off_intervals, init_codebook, rng, adjacency):
+        if n_rows == len(buffer):
+            buffer = np.concatenate((buffer, np.zeros_like(buffer)))
+        buffer[n_rows] = row
+        counts += row
+        n_rows += 1
+        if counts.min() == n_min_highlights:
+            yield buffer[:n_rows]
+            counts[:] = 0
+            n_rows = 0
+
+
+def gen_codebook(init_codebook: np.ndarray, n_objs, n_obj_highlights, n_off_intervals, n_min_highlights, rng: np.random.Generator=None, method: str='random', adjacency=None):
     assert n_off_intervals < n_objs // n_obj_highlights
     codebook = init_codebook
-    while True:
-        if n_off_intervals == 0:
-            prev_rows = np.zeros((0, n_objs))
+    if method in ('solver', 'solver_uniform'):
+        if adjacency is not None:
+            raise ValueError('The solver only supports objects in a single row')
+        solver = get_solver(n_objs, n_obj_highlights, n_off_intervals, n_min_highlights)
+        if method == 'solver':
+            # Randomized depth-first search, bounded number of search steps
+            new_rows = solver.draw(init_codebook, rng=RNG if rng is None else rng)
         else:
-            prev_rows = codebook[-n_off_intervals:].copy()
-        new_row = gen_row(n_objs, prev_rows, n_obj_highlights)
-        if 99 not in new_row:
-            codebook = np.vstack((codebook, new_row))
-        if codebook[init_codebook.shape[0]:].sum(axis=0).min() == n_min_highlights:
-            break
-        
+            # Exactly uniform over all valid codebooks, refused where the solution count blows up
+            new_rows = solver.sample(init_codebook, rng=RNG if rng is None else rng)
+        codebook = np.vstack((codebook, new_rows))
+    elif method == 'graph':
+        # Random walk over the precomputed valid rows, no rejection
+        graph = get_row_graph(n_objs, n_obj_highlights, n_off_intervals, adjacency)
+        new_rows = graph.walk_block(n_min_highlights, init_codebook, rng=RNG if rng is None else rng)
+        codebook = np.vstack((codebook, new_rows))
+    elif method == 'random':
+        # First block of the row stream after init_codebook
+        new_rows = next(iter_blocks(
+            n_objs, n_obj_highlights, n_off_intervals, n_min_highlights, init_codebook, rng=rng, adjacency=adjacency
+        ))
+        codebook = np.vstack((codebook, new_rows))
+    else:
+        raise ValueError(f'Unknown method: {method}')
+
     codebook = codebook[1:]
     codebook = [i for i in codebook.tolist() if i != [2] * n_objs]
     codebook = np.array(codebook)
     return codebook
 
-def exist_spatial_neighbors(codebook):
-    for i in range(codebook.shape[0]):
-        for j in range(codebook.shape[1] - 1):
-            if codebook[i, j:j+2].dot(np.array([1, 1])) == 2:
-                return True
-    return False
+def exist_spatial_neighbors(codebook, adjacency=None):
+    if adjacency is None:
+        if codebook.shape[-1] <= 64:
+            return has_spatial_neighbors(pack_codebook(codebook))
+        adjacency = row_layout(codebook.shape[-1])
+    return has_adjacent_highlights(codebook, adjacency)
 
 def compute_diag_neighbors(codebook: np.ndarray, kernel_size=(3, 3)) -> int:
     kernel_1 = np.zeros(kernel_size)
@@ -80,77 +186,356 @@ def compute_diag_neighbors(codebook: np.ndarray, kernel_size=(3, 3)) -> int:
     else:
         return (cnts_1[vals_1 == kernel_size[0]].sum() + cnts_2[vals_2 == kernel_size[0]].sum()).item()
 
-def generate_single_trial(n_reps=12) -> np.ndarray:
+def count_diag_neighbors_added(prev_rows: np.ndarray, new_rows: np.ndarray, kernel_size=(3, 3)) -> int:
+    """Incremental compute_diag_neighbors for a trial built block by block.
+
+    Rows are time steps (as returned by gen_codebook). Counts the full diagonal and
+    anti-diagonal runs that end inside new_rows once appended after prev_rows, so summing it
+    over all blocks gives compute_diag_neighbors of the whole trial.
+    """
+    k = kernel_size[0]
+    rows = new_rows if prev_rows is None else np.vstack((prev_rows[len(prev_rows) - (k - 1):], new_rows))
+    rows = rows == 1
+    n_rows, n_objs = rows.shape
+    if n_rows < k or n_objs < k:
+        return 0
+    down = np.ones((n_rows - k + 1, n_objs - k + 1), dtype=bool)
+    up = np.ones((n_rows - k + 1, n_objs - k + 1), dtype=bool)
+    for d in range(k):
+        down &= rows[d:n_rows - k + 1 + d, d:n_objs - k + 1 + d]
+        up &= rows[d:n_rows - k + 1 + d, k - 1 - d:n_objs - d]
+    return int(down.sum() + up.sum())
+
+def _save_checkpoint(fpath: str, **state) -> None:
+    # Write to a temporary file first so a kill during the write never corrupts the last checkpoint
+    tmp_fpath = fpath + '.tmp'
+    with open(tmp_fpath, 'wb') as f:
+        np.savez(f, **state)
+    os.replace(tmp_fpath, fpath)
+
+def _load_checkpoint(fpath: str) -> dict:
+    if fpath is None or not os.path.exists(fpath):
+        return None
+    with np.load(fpath) as f:
+        return {key: f[key] for key in f.files}
+
+class StopRule:
+    """Shared by the workers of one trial: the first zero-diagonal codebook as (restart index, worker id).
+
+    A worker stops once its own restart index is past the recorded one, so every worker still runs
+    all restarts that could give an earlier zero and the winner does not depend on timing.
+    """
+    def __init__(self, manager):
+        self._first_zero = manager.Value('O', None)
+        self._lock = manager.Lock()
+
+    def report(self, restart_id: int, worker_id: int) -> None:
+        with self._lock:
+            first_zero = self._first_zero.value
+            if first_zero is None or (restart_id, worker_id) < first_zero:
+                self._first_zero.value = (restart_id, worker_id)
+
+    def is_past(self, restart_id: int) -> bool:
+        first_zero = self._first_zero.value
+        return first_zero is not None and restart_id > first_zero[0]
+
+    @property
+    def first_zero(self) -> tuple:
+        return self._first_zero.value
+
+
+def search_restarts(
+        n_restarts: int, n_reps: int=12, rng: np.random.Generator=None, stop_rule: StopRule=None, worker_id: int=0, progress: bool=True,
+        n_objs: int=8, n_obj_highlights: int=2, n_off_intervals: int=3, n_min_highlights: int=1,
+        checkpoint_path: str=None, checkpoint_every: int=100, adjacency=None, method: str='random'
+    ):
+    """Random restart search. Returns (best_codebooks, best_diag_val).
+
+    Objects are in a single row by default. With a sparse adjacency from layouts.py, neighbors come from
+    that layout and the diagonal score counts flashes moving on over two neighbors (count_neighbor_paths).
+    method='graph' draws blocks as walks on the row graph (row_graph.py) that continue from the previous block.
+
+    Stops early on a zero-diagonal codebook, or once stop_rule has a zero from another worker at an
+    earlier restart index (worker_id breaks ties).
+    With checkpoint_path, the best codebook, restart count, init_codebook and generator state are saved
+    every checkpoint_every restarts, and a later call with the same path continues from there.
+    """
+    if rng is None:
+        rng = RNG
+    params = {
+        'n_restarts': n_restarts, 'n_reps': n_reps, 'n_objs': n_objs, 'n_obj_highlights': n_obj_highlights,
+        'n_off_intervals': n_off_intervals, 'n_min_highlights': n_min_highlights
+    }
+    if adjacency is not None:
+        params['layout'] = layout_key(adjacency)
+        params['objective'] = 'neighbor_paths'
+    if method != 'random':
+        params['method'] = method
+    params = json.dumps(params)
     best_codebooks = None
     best_diag_val = np.inf
-    init_codebook = np.zeros((1, 8))
-    
-    for _ in tqdm(range(10000)):
+    init_codebook = np.zeros((1, n_objs))
+    restarts_done = 0
+    finished = False
+
+    checkpoint = _load_checkpoint(checkpoint_path)
+    if checkpoint is not None:
+        if str(checkpoint['params']) != params:
+            raise ValueError(f'Checkpoint {checkpoint_path} was made with other parameters: {checkpoint["params"]}')
+        restarts_done = int(checkpoint['restarts_done'])
+        finished = bool(checkpoint['finished'])
+        if np.isfinite(checkpoint['best_diag_val']):
+            best_codebooks = checkpoint['best_codebooks']
+            best_diag_val = int(checkpoint['best_diag_val'])
+        init_codebook = checkpoint['init_codebook']
+        rng.bit_generator.state = json.loads(str(checkpoint['rng_state']))
+
+    def save_checkpoint():
+        if checkpoint_path is not None:
+            _save_checkpoint(
+                checkpoint_path, params=params, restarts_done=restarts_done, finished=finished,
+                best_codebooks=np.zeros(0) if best_codebooks is None else best_codebooks, best_diag_val=best_diag_val,
+                init_codebook=init_codebook, rng_state=json.dumps(rng.bit_generator.state)
+            )
+
+    if finished:
+        # A resumed zero still stops the other workers of the trial, as it did before the interruption.
+        # The search ends right after the restart that found it.
+        if best_diag_val == 0 and stop_rule is not None:
+            stop_rule.report(restarts_done - 1, worker_id)
+        return best_codebooks, best_diag_val
+
+    for _ in tqdm(range(restarts_done, n_restarts), initial=restarts_done, total=n_restarts, disable=not progress):
+        if stop_rule is not None and stop_rule.is_past(restarts_done):
+            break
         codebooks = []
         init_codebook = gen_codebook(
             init_codebook = init_codebook,
-            n_objs=8, n_obj_highlights=2, n_off_intervals=3, n_min_highlights=1
+            n_objs=n_objs, n_obj_highlights=n_obj_highlights, n_off_intervals=n_off_intervals, n_min_highlights=n_min_highlights, rng=rng, adjacency=adjacency, method=method
         )
+        diag_val = 0
         for _ in range(n_reps):
+            # A graph walk continues from the previous block, so it passes both checks at the first try
+            block_init = init_codebook[-1:] if method == 'graph' else np.zeros((1, n_objs))
             while True:
                 codebook = gen_codebook(
-                    init_codebook = np.zeros((1, 8)),
-                    n_objs=8, n_obj_highlights=2, n_off_intervals=3, n_min_highlights=1
+                    init_codebook = block_init,
+                    n_objs=n_objs, n_obj_highlights=n_obj_highlights, n_off_intervals=n_off_intervals, n_min_highlights=n_min_highlights, rng=rng, adjacency=adjacency, method=method
                 )
-                prev_idc = np.where(init_codebook[-1] == 1)[0]
-                if codebook[0, prev_idc[0]] == 0 and codebook[0, prev_idc[1]] == 0:
-                    if not exist_spatial_neighbors(codebook):
+                # The block may not start with an object the previous block ended with
+                if not (codebook[0] * init_codebook[-1]).any():
+                    if not exist_spatial_neighbors(codebook, adjacency):
                         break
                 
+            if adjacency is None:
+                diag_val += count_diag_neighbors_added(np.vstack(codebooks[-2:]) if codebooks else None, codebook, kernel_size=(3, 3))
+            else:
+                prev_rows = np.vstack(codebooks[-2:])[-2:] if codebooks else codebook[:0]
+                diag_val += count_neighbor_paths(np.vstack((prev_rows, codebook)), adjacency)
             codebooks.append(codebook)
             init_codebook = codebook
-
-        codebooks = np.vstack(codebooks).T
-        
-        diag_val = compute_diag_neighbors(codebooks, kernel_size=(3, 3))
-        if diag_val < best_diag_val:
-            best_codebooks = codebooks
-            best_diag_val = diag_val
-            if diag_val == 0:
+            # The score only grows with every block, abandon candidates that can no longer win
+            if diag_val >= best_diag_val:
                 break
+        else:
+            best_codebooks = np.vstack(codebooks).T
+            best_diag_val = diag_val
+        restarts_done += 1
+        if best_diag_val == 0:
+            if stop_rule is not None:
+                stop_rule.report(restarts_done - 1, worker_id)
+            break
+        if restarts_done % checkpoint_every == 0:
+            save_checkpoint()
+
+    finished = True
+    save_checkpoint()
+    return best_codebooks, best_diag_val
+
+def _search_worker(n_restarts: int, n_reps: int, seed_seq: np.random.SeedSequence, stop_rule: StopRule, worker_id: int, constraints: dict, checkpoint_path: str, checkpoint_every: int, adjacency, method: str):
+    return search_restarts(
+        n_restarts, n_reps, rng=np.random.default_rng(seed_seq), stop_rule=stop_rule, worker_id=worker_id, progress=False,
+        checkpoint_path=checkpoint_path, checkpoint_every=checkpoint_every, adjacency=adjacency, method=method, **constraints
+    )
+
+def generate_trials(
+        n_trials: int=8, n_reps: int=12, n_restarts: int=10000, n_workers: int=1, seed: int=42,
+        n_objs: int=8, n_obj_highlights: int=2, n_off_intervals: int=3, n_min_highlights: int=1,
+        checkpoint_dir: str=None, checkpoint_every: int=100, cache: CodebookCache=None, adjacency=None, method: str='random'
+    ) -> list:
+    """Run the restart search for n_trials objects, spread over a process pool.
+
+    Every trial splits its restart budget over n_workers workers. Each worker draws from its own
+    child of SeedSequence(seed), so every worker explores the same candidates in the same order for a
+    given (seed, n_workers). A zero-diagonal codebook stops the workers that are past its restart index
+    (StopRule), the trial gets the zero with the lowest (restart index, worker id). How far the other
+    workers get before they stop depends on timing, but not which codebook is returned.
+    With checkpoint_dir, every search (trial and worker) checkpoints to its own file and resumes from it.
+    With cache, trials already generated with the same parameters are returned without searching.
+    adjacency (an optional sparse object layout) and method are passed on to search_restarts.
+    """
+    constraints = dict(n_objs=n_objs, n_obj_highlights=n_obj_highlights, n_off_intervals=n_off_intervals, n_min_highlights=n_min_highlights)
+    # The default single row and random method keep their old cache keys
+    key_options = {} if adjacency is None else {'layout': layout_key(adjacency), 'objective': 'neighbor_paths'}
+    if method != 'random':
+        key_options['method'] = method
+    trial_seeds = np.random.SeedSequence(seed).spawn(n_trials)
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def checkpoint_path(trial_id: int, worker_id: int):
+        if checkpoint_dir is None:
+            return None
+        return os.path.join(checkpoint_dir, f'trial_{trial_id}_worker_{worker_id}_of_{n_workers}.npz')
+
+    # Restart budget and worker count change which candidates are explored, so they are part of the key
+    cache_keys = [
+        cache.key(
+            generator_version=GENERATOR_VERSION, seed=seed, trial_id=trial_id, n_reps=n_reps,
+            n_restarts=n_restarts, n_workers=n_workers, **key_options, **constraints
+        ) if cache is not None else None
+        for trial_id in range(n_trials)
+    ]
+    trials = [cache.get(key) if cache is not None else None for key in cache_keys]
+    missing_ids = [trial_id for trial_id, trial in enumerate(trials) if trial is None]
+
+    if n_workers == 1:
+        for trial_id in missing_ids:
+            trials[trial_id] = generate_single_trial(
+                n_reps=n_reps, rng=np.random.default_rng(trial_seeds[trial_id]), n_restarts=n_restarts,
+                checkpoint_path=checkpoint_path(trial_id, 0), checkpoint_every=checkpoint_every, adjacency=adjacency, method=method, **constraints
+            )
+    elif missing_ids:
+        worker_restarts = [len(chunk) for chunk in np.array_split(np.arange(n_restarts), n_workers)]
+        with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=n_workers) as executor:
+            stop_rules = {trial_id: StopRule(manager) for trial_id in missing_ids}
+            futures = {
+                trial_id: [
+                    executor.submit(
+                        _search_worker, n, n_reps, worker_seed, stop_rules[trial_id], worker_id, constraints,
+                        checkpoint_path(trial_id, worker_id), checkpoint_every, adjacency, method
+                    )
+                    for worker_id, (n, worker_seed) in enumerate(zip(worker_restarts, trial_seeds[trial_id].spawn(n_workers)))
+                ]
+                for trial_id in missing_ids
+            }
+            for trial_id, trial_futures in tqdm(futures.items()):
+                results = [f.result() for f in trial_futures]
+                first_zero = stop_rules[trial_id].first_zero
+                if first_zero is not None:
+                    best_codebooks, best_diag_val = results[first_zero[1]]
+                else:
+                    # No early stop, every worker ran its full budget. Ties go to the lowest worker index.
+                    best_codebooks, best_diag_val = min(results, key=lambda result: result[1])
+                print('Lest diag neighbors:', best_diag_val)
+                trials[trial_id] = best_codebooks
+
+    if cache is not None:
+        for trial_id in missing_ids:
+            cache.put(cache_keys[trial_id], trials[trial_id])
+    return trials
+
+def generate_single_trial(
+        n_reps=12, rng: np.random.Generator=None, n_restarts: int=10000, n_workers: int=1, seed: int=42,
+        n_objs: int=8, n_obj_highlights: int=2, n_off_intervals: int=3, n_min_highlights: int=1,
+        checkpoint_path: str=None, checkpoint_every: int=100, cache: CodebookCache=None, adjacency=None, method: str='random'
+    ) -> np.ndarray:
+    constraints = dict(n_objs=n_objs, n_obj_highlights=n_obj_highlights, n_off_intervals=n_off_intervals, n_min_highlights=n_min_highlights)
+    if n_workers > 1 or cache is not None:
+        # Seeded paths: the trial is fully determined by its parameters and seed (rng is not used)
+        checkpoint_dir = None if checkpoint_path is None else os.path.splitext(checkpoint_path)[0]
+        return generate_trials(
+            n_trials=1, n_reps=n_reps, n_restarts=n_restarts, n_workers=n_workers, seed=seed,
+            checkpoint_dir=checkpoint_dir, checkpoint_every=checkpoint_every, cache=cache, adjacency=adjacency, method=method, **constraints
+        )[0]
+    best_codebooks, best_diag_val = search_restarts(
+        n_restarts, n_reps, rng=rng, checkpoint_path=checkpoint_path, checkpoint_every=checkpoint_every, adjacency=adjacency, method=method, **constraints
+    )
     print('Lest diag neighbors:', best_diag_val)
     return best_codebooks
 
 
-def main():
+def main(
+        n_objs: int=8, n_obj_highlights: int=2, n_off_intervals: int=3, n_min_highlights: int=1, n_reps: int=12,
+        n_restarts: int=10000, seed: int=42, output: str='.', n_workers: int=1, checkpoint_every: int=100,
+        skip_render: bool=False, montage: bool=False, cache_dir: str=CACHE_DIR, cache_size_mb: float=256, grid: str=None, method: str='random'
+    ):
+    np.random.seed(seed)
+    # Objects in one row by default, or on a grid such as '6x6' (overrides n_objs)
+    adjacency = None
+    if grid:
+        n_rows, n_cols = parse_grid(grid)
+        n_objs = n_rows * n_cols
+        adjacency = grid_layout(n_rows, n_cols)
+    for dirname in ['codebooks/condition_1', 'codebooks/condition_2']:
+        os.makedirs(os.path.join(output, dirname), exist_ok=True)
+
     # Condition 1
-    for i in range(8):
-        codebook = np.repeat(np.eye(8), 12, axis=1)
-        idc = np.random.permutation(np.arange(8)) # randomly shift rows
+    for i in range(n_objs):
+        codebook = np.repeat(np.eye(n_objs), n_reps, axis=1)
+        idc = np.random.permutation(np.arange(n_objs)) # randomly shift rows
         codebook = codebook[idc]
 
-        # Save stimulus as image
-        plt.figure(figsize=(10, 7))
-        plt.imshow(codebook)
-        plt.tight_layout()
-        plt.savefig(f'./images/codebook_condition_1/codebook_obj_{i}.png', format='png')
-        plt.clf()
-        plt.cla()
-        plt.close()
-
         # Save stimulus as npy file
-        np.save(f'./codebooks/condition_1/codebook_obj_{i}.npy', codebook)
+        np.save(f'{output}/codebooks/condition_1/codebook_obj_{i}.npy', codebook)
 
     # Condition 2
-    for i in range(8):
-        trial_stim = generate_single_trial()
-        
-        # Save stimulus as image
-        plt.figure(figsize=(10, 7))
-        plt.imshow(trial_stim)
-        plt.tight_layout()
-        plt.savefig(f'./images/condition_2/codebook_obj_{i}.png', format='png')
-        plt.clf()
-        plt.cla()
-        plt.close()
-        
+    # Checkpoints are keyed by the search parameters, so a rerun with the same arguments resumes
+    run_key = json.dumps(
+        [n_objs, n_obj_highlights, n_off_intervals, n_min_highlights, n_reps, n_restarts, seed]
+        + ([grid] if grid else []) + ([method] if method != 'random' else [])
+    )
+    checkpoint_dir = os.path.join(output, 'checkpoints', hashlib.sha1(run_key.encode()).hexdigest()[:12])
+    trial_stims = generate_trials(
+        n_trials=n_objs, n_reps=n_reps, n_restarts=n_restarts, n_workers=n_workers, seed=seed,
+        n_objs=n_objs, n_obj_highlights=n_obj_highlights, n_off_intervals=n_off_intervals, n_min_highlights=n_min_highlights,
+        checkpoint_dir=checkpoint_dir, checkpoint_every=checkpoint_every,
+        cache=CodebookCache(cache_dir, max_bytes=int(cache_size_mb * 2**20)) if cache_dir else None, adjacency=adjacency, method=method
+    )
+    for i, trial_stim in enumerate(trial_stims):
         # Save stimulus as npy file
-        np.save(f'./codebooks/condition_2/codebook_obj_{i}.npy', trial_stim)
+        np.save(f'{output}/codebooks/condition_2/codebook_obj_{i}.npy', trial_stim)
+
+    # Keep the archive read by the experiment in sync with the .npy files. The cVEP code families are not
+    # generated here, they always come from the source tree.
+    generation = {
+        'condition_1': {'generator_version': GENERATOR_VERSION, 'seed': seed, 'n_objs': n_objs, 'n_reps': n_reps},
+        'condition_2': {
+            'generator_version': GENERATOR_VERSION, 'seed': seed, 'n_objs': n_objs, 'n_obj_highlights': n_obj_highlights,
+            'n_off_intervals': n_off_intervals, 'n_min_highlights': n_min_highlights, 'n_reps': n_reps,
+            'n_restarts': n_restarts, 'n_workers': n_workers, 'method': method,
+            'grid': grid, 'layout': layout_key(adjacency),
+        },
+    }
+    build_archive(
+        fpath=f'{output}/codebooks/codebooks.cbar', path=f'{output}/codebooks', n_reps=n_reps, n_objs=n_objs,
+        condition_3_path=CONDITION_3_PATH, generation=generation
+    )
+
+    # Images are rendered after the search, in their own worker pool (also available as render_codebooks.py)
+    if not skip_render:
+        render_all(output=output, montage=montage, n_workers=max(n_workers, 1))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Generate the condition 1 and 2 codebooks. Rerun with the same arguments to resume.')
+    parser.add_argument('--n-objs', type=int, default=8)
+    parser.add_argument('--grid', type=str, default=None, help='objects on a ROWSxCOLS grid, e.g. 6x6, instead of one row of n-objs')
+    parser.add_argument('--n-obj-highlights', type=int, default=2, help='highlighted objects per step')
+    parser.add_argument('--n-off-intervals', type=int, default=3, help='steps before an object may flash again')
+    parser.add_argument('--n-min-highlights', type=int, default=1, help='flashes per object in every repetition block')
+    parser.add_argument('--n-reps', type=int, default=12, help='repetition blocks per trial')
+    parser.add_argument('--n-restarts', type=int, default=10000, help='restart budget per trial')
+    parser.add_argument('--method', type=str, default='random', choices=['random', 'graph'], help='rejection sampling or walks on the valid-row graph')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default='.', help='writes codebooks/, images/ and checkpoints/ here')
+    parser.add_argument('--n-workers', type=int, default=1)
+    parser.add_argument('--checkpoint-every', type=int, default=100, help='restarts between checkpoints')
+    parser.add_argument('--skip-render', action='store_true', help='do not render codebook images')
+    parser.add_argument('--montage', action='store_true', help='render one image per condition')
+    parser.add_argument('--cache-dir', type=str, default=CACHE_DIR, help='cache of generated trials, empty string disables it')
+    parser.add_argument('--cache-size-mb', type=float, default=256, help='least recently used trials are evicted above this size')
+    return parser.parse_args()
 
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main(**vars(parse_args()))
@@ -0,0 +1,79 @@
+import time
+import queue
+import logging
+import threading
+import collections
+import numpy as np
+from pylsl import local_clock
+
+
+class IOWorker:
+    """Serial writes and marker pushes on a background thread, fed through a bounded queue.
+
+    The timing loops only enqueue, which never blocks: a full queue drops the item and counts it.
+    Marker timestamps are taken with local_clock() when the marker is enqueued, so a slow push does
+    not shift them. Jobs run in the order they were enqueued.
+    """
+    def __init__(self, maxsize: int=4096, history: int=5000, name: str='io_worker'):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._latencies = collections.deque(maxlen=history)  # Enqueue to done, seconds
+        self._depths = collections.deque(maxlen=history)  # Queue size seen by every enqueue
+        self.n_dropped = 0
+        self.n_errors = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args) -> bool:
+        """Queue fn(*args), returns False if the queue was full and the job was dropped"""
+        try:
+            self._queue.put_nowait((time.perf_counter(), fn, args))
+        except queue.Full:
+            self.n_dropped += 1
+            return False
+        self._depths.append(self._queue.qsize())
+        return True
+
+    def write(self, device, data: bytes) -> bool:
+        return self.submit(device.write, data)
+
+    def push_sample(self, outlet, sample: list, timestamp: float=None) -> bool:
+        """outlet.push_sample with the timestamp of now, or the given local_clock() time"""
+        return self.submit(outlet.push_sample, sample, local_clock() if timestamp is None else timestamp)
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            enqueued, fn, args = job
+            try:
+                fn(*args)
+            except Exception:
+                self.n_errors += 1
+                logging.exception('I/O job failed')
+            self._latencies.append(time.perf_counter() - enqueued)
+            self._queue.task_done()
+
+    def flush(self) -> None:
+        """Block until every queued job ran"""
+        self._queue.join()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self) -> dict:
+        """Queue depth and enqueue-to-done latency over the recent jobs, latencies in seconds"""
+        latencies = np.array(self._latencies)
+        depths = np.array(self._depths)
+        return {
+            'n_jobs': len(latencies),
+            'n_dropped': self.n_dropped,
+            'n_errors': self.n_errors,
+            'depth': self._queue.qsize(),
+            'depth_max': int(depths.max()) if len(depths) else 0,
+            'latency_mean': float(latencies.mean()) if len(latencies) else np.nan,
+            'latency_p99': float(np.quantile(latencies, 0.99)) if len(latencies) else np.nan,
+            'latency_max': float(latencies.max()) if len(latencies) else np.nan,
+        }
@@ -0,0 +1,47 @@
+from typing import List, Sequence
+import numpy as np
+from laser_protocol import encode_state, encode_ascii
+
+
+class ChannelMap:
+    """Wiring of the lasers: logical object j drives Teensy pin wiring[j], optionally mirrored.
+
+    Compiled once into tables over all 2 ** n_channels logical states (bit j is object j, as in
+    FramePlan.states), so sending a state is a single lookup.
+    """
+    def __init__(self, wiring: Sequence[int], mirror: bool=False):
+        self.n_channels = len(wiring)
+        if sorted(wiring) != list(range(self.n_channels)):
+            raise ValueError(f'Wiring must be a permutation of 0..{self.n_channels - 1}: {wiring}')
+        if self.n_channels > 8:
+            raise ValueError(f'The firmware drives at most 8 lasers, got {self.n_channels}')
+        self.wiring = list(wiring)
+        self.mirror = mirror
+        pins = [self.n_channels - 1 - pin if mirror else pin for pin in self.wiring]
+        self.pins = np.array(pins, dtype=np.uint8)  # Pin of every logical object
+
+        states = np.arange(2 ** self.n_channels, dtype=np.uint16)
+        bits = (states[:, None] >> np.arange(self.n_channels, dtype=np.uint16)) & 1
+        self.wire_masks = np.bitwise_or.reduce(bits << self.pins.astype(np.uint16), axis=1).astype(np.uint8)
+
+    @property
+    def all_on(self) -> int:
+        return 2 ** self.n_channels - 1
+
+    def wire_values(self, state: int) -> List[int]:
+        """Logical state -> per pin values, as sent by the ascii protocol"""
+        mask = int(self.wire_masks[state])
+        return [(mask >> pin) & 1 for pin in range(self.n_channels)]
+
+    def compile(self, protocol: str='binary') -> List[bytes]:
+        """Ready-to-send bytes for every logical state"""
+        if protocol == 'binary':
+            return [encode_state(int(mask)) for mask in self.wire_masks]
+        if protocol == 'ascii':
+            return [encode_ascii(self.wire_values(state)) for state in range(len(self.wire_masks))]
+        raise ValueError(f'Unknown protocol: {protocol}')
+
+
+# Lasers 3, 4 and 5 were rewired to positions 5, 3 and 4, and the sequences are mirrored so that the
+# stimuli are correctly presented
+LASER_CHANNEL_MAP = ChannelMap(wiring=[0, 1, 2, 5, 3, 4, 6, 7], mirror=True)
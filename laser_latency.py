@@ -0,0 +1,151 @@
+import queue
+import threading
+import collections
+import numpy as np
+from pylsl import StreamOutlet, StreamInfo, local_clock
+from laser_protocol import parse_reply
+
+
+class ClockFit:
+    """Running least squares fit host_time = slope * device_time + offset over the recent pairs.
+
+    Times are in seconds, the fit is centered on the window mean so large clock values keep their precision.
+    """
+    def __init__(self, window: int=500, min_pairs: int=10):
+        self.min_pairs = min_pairs
+        self._device = collections.deque(maxlen=window)
+        self._host = collections.deque(maxlen=window)
+        self.slope = 1.0
+        self._device_mean = 0.0
+        self._host_mean = 0.0
+
+    def __len__(self) -> int:
+        return len(self._device)
+
+    def add(self, device_time: float, host_time: float) -> None:
+        self._device.append(device_time)
+        self._host.append(host_time)
+        device, host = np.array(self._device), np.array(self._host)
+        self._device_mean, self._host_mean = device.mean(), host.mean()
+        if len(device) >= self.min_pairs:
+            device = device - self._device_mean
+            variance = device @ device
+            if variance > 0:
+                self.slope = float(device @ (host - self._host_mean) / variance)
+
+    def __call__(self, device_time: float) -> float:
+        """Host time of a device time, slope 1 until min_pairs pairs were seen"""
+        return self._host_mean + self.slope * (device_time - self._device_mean)
+
+
+class AckMonitor:
+    """Reads the Teensy's replies on a thread and measures how long states take to reach the pins.
+
+    Every acknowledged state has three times: enqueued (send_state was called), written (the serial
+    write started) and received (the ACK line arrived), all local_clock(). The device's micros() of the
+    switch is mapped to host time with a ClockFit of the device time against the middle of write and
+    receive, i.e. assuming symmetric USB latency. Onset latency is the mapped switch time minus the
+    enqueue time. Latencies go to a fixed-bin histogram, stats() and an LSL stream whose samples are
+    [latency, write_latency, seq] timestamped at the onset. Other replies are put on replies.
+    """
+    def __init__(self, teensy, bin_width: float=0.00025, max_latency: float=0.02, history: int=5000, stream: bool=True):
+        self.teensy = teensy
+        self.clock_fit = ClockFit()
+        self.replies = queue.Queue()
+        self.bin_edges = np.arange(0, max_latency + bin_width / 2, bin_width)
+        self.counts = np.zeros(len(self.bin_edges) + 1, dtype=np.int64)  # Last bin counts everything above max_latency
+        self._latencies = collections.deque(maxlen=history)
+        self._write_latencies = collections.deque(maxlen=history)
+        self._pending = [None] * 256  # (enqueued, written) per sequence number
+        self._last_micros = None
+        self._wraps = 0
+        self.n_acks = 0
+        self.n_unmatched = 0
+        self.outlet = None
+        if stream:
+            info = StreamInfo(name='LaserLatencyStream', type='Latency', channel_count=3, channel_format=2, nominal_srate=0, source_id='laser_latency_stream_id')
+            self.outlet = StreamOutlet(info)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='laser_acks', daemon=True)
+        self._thread.start()
+
+    def enqueued(self, seq: int) -> None:
+        self._pending[seq] = (local_clock(), None)
+
+    def written(self, seq: int) -> None:
+        pending = self._pending[seq]
+        if pending is not None:
+            self._pending[seq] = (pending[0], local_clock())
+
+    def _run(self) -> None:
+        while self._running:
+            try:
+                line = self.teensy.readline()
+            except Exception:
+                if self._running:
+                    raise
+                return
+            if not line:
+                continue
+            received = local_clock()
+            reply, argument = parse_reply(line)
+            if reply == 'ACK':
+                seq, device_micros = map(int, argument.split())
+                self._on_ack(seq, device_micros, received)
+            elif reply:
+                self.replies.put((reply, argument))
+
+    def _device_time(self, device_micros: int) -> float:
+        """micros() in seconds, unwrapped over its 2 ** 32 us (~71 min) overflow"""
+        if self._last_micros is not None and device_micros < self._last_micros:
+            self._wraps += 1
+        self._last_micros = device_micros
+        return (device_micros + self._wraps * 2 ** 32) / 1e6
+
+    def host_time(self, device_micros: int) -> float:
+        """local_clock() time of a device micros() reading, e.g. a playback START, None before the first ACK"""
+        if len(self.clock_fit) == 0:
+            return None
+        wraps = self._wraps + (device_micros < self._last_micros)
+        return self.clock_fit((device_micros + wraps * 2 ** 32) / 1e6)
+
+    def _on_ack(self, seq: int, device_micros: int, received: float) -> None:
+        device_time = self._device_time(device_micros)
+        pending = self._pending[seq]
+        self._pending[seq] = None
+        if pending is None or pending[1] is None:
+            self.n_unmatched += 1
+            return
+        enqueued, written = pending
+        self.clock_fit.add(device_time, (written + received) / 2)
+        onset = self.clock_fit(device_time)
+        latency, write_latency = onset - enqueued, onset - written
+        self.n_acks += 1
+        self._latencies.append(latency)
+        self._write_latencies.append(write_latency)
+        self.counts[np.searchsorted(self.bin_edges, latency, side='right')] += 1
+        if self.outlet is not None:
+            self.outlet.push_sample([latency, write_latency, seq], onset)
+
+    def histogram(self) -> tuple:
+        """(bin_edges, counts) of all onset latencies, counts[0] is negative and counts[-1] above the last edge"""
+        return self.bin_edges, self.counts.copy()
+
+    def stats(self) -> dict:
+        """Onset latency over the recent acknowledged states, in seconds"""
+        latencies = np.array(self._latencies)
+        write_latencies = np.array(self._write_latencies)
+        return {
+            'n_acks': self.n_acks,
+            'n_unmatched': self.n_unmatched,
+            'clock_slope': self.clock_fit.slope,
+            'latency_mean': float(latencies.mean()) if len(latencies) else np.nan,
+            'latency_p99': float(np.quantile(latencies, 0.99)) if len(latencies) else np.nan,
+            'latency_max': float(latencies.max()) if len(latencies) else np.nan,
+            'write_latency_mean': float(write_latencies.mean()) if len(write_latencies) else np.nan,
+            'write_latency_max': float(write_latencies.max()) if len(write_latencies) else np.nan,
+        }
+
+    def close(self) -> None:
+        self._running = False
+        self._thread.join()
@@ -0,0 +1,85 @@
+from typing import List
+import struct
+import numpy as np
+
+# Binary protocol of laser_serial_listener.ino. A state is one framing byte followed by one bitmask
+# byte, bit i drives laser pin i. With sequence numbers the framing byte is SYNC_STATE_SEQ and a
+# wrapping uint8 counter comes before the bitmask, so the firmware can count lost states.
+SYNC_STATE = 0xA5
+SYNC_STATE_SEQ = 0xA6
+# Same as SYNC_STATE_SEQ, the firmware answers "ACK <seq> <micros>" right after switching the pins
+SYNC_STATE_ACK = 0xA9
+
+# Hardware-timed playback: SYNC_UPLOAD, uint16 n_segments, n_segments * (uint8 mask, uint32 duration_us),
+# uint8 sum of the segment bytes. The firmware answers "UPLOADED <n>" or "ERR <reason>". SYNC_START then
+# plays the segments from a hardware timer and the firmware reports "START <micros>" and "END <micros>".
+SYNC_UPLOAD = 0xA7
+SYNC_START = 0xA8
+# SYNC_STATUS asks for "STATUS <n_dropped> <last_seq>", the states lost according to the sequence numbers
+SYNC_STATUS = 0xAA
+MAX_SEGMENTS = 4096  # Size of the trial buffer in the firmware
+SEGMENT_DTYPE = np.dtype([('mask', 'u1'), ('duration_us', '<u4')])  # Packed, 5 bytes
+
+
+def values_to_mask(values: List[int]) -> int:
+    """[v0, v1, ...] -> bitmask with bit i set where values[i] > 0"""
+    mask = 0
+    for i, value in enumerate(values):
+        if value > 0:
+            mask |= 1 << i
+    return mask
+
+def encode_state(mask: int, seq: int=None, ack: bool=False) -> bytes:
+    """2 bytes, or 3 with a sequence number, which acknowledged states need"""
+    if seq is None:
+        if ack:
+            raise ValueError('Acknowledged states need a sequence number')
+        return bytes((SYNC_STATE, mask))
+    return bytes((SYNC_STATE_ACK if ack else SYNC_STATE_SEQ, seq & 0xFF, mask))
+
+def encode_ascii(values: List[int]) -> bytes:
+    """Original line protocol, "0,0,0,1,0,0,0,0\n", still understood by the firmware"""
+    return (",".join(map(str, values)) + "\n").encode()
+
+def decode_states(data: bytes) -> list:
+    """Host-side reference of the firmware parser for binary states: [(seq or None, mask), ...]"""
+    states = []
+    i = 0
+    while i < len(data):
+        if data[i] == SYNC_STATE and i + 1 < len(data):
+            states.append((None, data[i + 1]))
+            i += 2
+        elif data[i] in (SYNC_STATE_SEQ, SYNC_STATE_ACK) and i + 2 < len(data):
+            states.append((data[i + 1], data[i + 2]))
+            i += 3
+        else:
+            i += 1
+    return states
+
+def trial_segments(masks: np.ndarray, durations: list) -> np.ndarray:
+    """Per step masks and step durations, e.g. [on, off] in seconds -> SEGMENT_DTYPE array.
+
+    The first duration of a step shows its mask, the remaining ones turn all lasers off.
+    """
+    masks = np.asarray(masks, dtype=np.uint8)
+    segments = np.zeros(len(masks) * len(durations), dtype=SEGMENT_DTYPE)
+    segments['mask'][::len(durations)] = masks
+    segments['duration_us'] = np.tile(np.round(np.asarray(durations) * 1e6).astype(np.uint32), len(masks))
+    return segments
+
+def encode_upload(segments: np.ndarray) -> bytes:
+    if len(segments) > MAX_SEGMENTS:
+        raise ValueError(f'{len(segments)} segments do not fit the firmware buffer of {MAX_SEGMENTS}')
+    body = np.ascontiguousarray(segments, dtype=SEGMENT_DTYPE).tobytes()
+    return bytes((SYNC_UPLOAD,)) + struct.pack('<H', len(segments)) + body + bytes((sum(body) & 0xFF,))
+
+def encode_start() -> bytes:
+    return bytes((SYNC_START,))
+
+def encode_status() -> bytes:
+    return bytes((SYNC_STATUS,))
+
+def parse_reply(line: bytes) -> tuple:
+    """Firmware reply line, e.g. b"START 123\\r\\n" -> ('START', '123')"""
+    keyword, _, argument = line.decode(errors='replace').strip().partition(' ')
+    return keyword, argument
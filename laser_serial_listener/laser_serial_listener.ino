@@ -1,34 +1,253 @@
 const int ledPins[] = {0, 1, 2, 3, 4, 5, 6, 7};  // LED pins
+const int nPins = 8;
+
+// Binary protocol (see laser_protocol.py): SYNC_STATE mask, or SYNC_STATE_SEQ seq mask.
+// Bit i of mask drives ledPins[i]. Lines like "0,0,0,1,0,0,0,0\n" are still accepted.
+const byte SYNC_STATE = 0xA5;
+const byte SYNC_STATE_SEQ = 0xA6;
+// SYNC_STATE_ACK seq mask: like SYNC_STATE_SEQ, then replies "ACK <seq> <micros>" once the pins switched
+const byte SYNC_STATE_ACK = 0xA9;
+
+// Hardware-timed playback: SYNC_UPLOAD n_lo n_hi, n * (mask, duration_us as uint32 LE), checksum.
+// SYNC_START plays the uploaded segments from an IntervalTimer, replies are text lines.
+const byte SYNC_UPLOAD = 0xA7;
+const byte SYNC_START = 0xA8;
+// SYNC_STATUS: replies "STATUS <nDropped> <lastSeq>"
+const byte SYNC_STATUS = 0xAA;
+const int MAX_SEGMENTS = 4096;
+
+enum ParserState { WAIT_SYNC, WAIT_SEQ, WAIT_MASK, ASCII_LINE, UPLOAD_LEN_LO, UPLOAD_LEN_HI, UPLOAD_BODY, UPLOAD_CHECKSUM };
+ParserState parserState = WAIT_SYNC;
+
+char line[32];  // ASCII line buffer, no String allocations
+int lineLen = 0;
+
+byte lastSeq = 0;
+bool hasSeq = false;
+bool ackState = false;  // Acknowledge the state being parsed
+unsigned long nDropped = 0;  // States lost according to the sequence numbers
+
+byte segMasks[MAX_SEGMENTS];
+uint32_t segDurations[MAX_SEGMENTS];
+int nSegments = 0;
+int uploadLen = 0;
+long uploadPos = 0;  // Byte position in the upload body
+byte uploadSum = 0;
+
+IntervalTimer playbackTimer;
+volatile int playIdx = 0;
+volatile bool playing = false;
+volatile bool reportStart = false;
+volatile bool reportEnd = false;
+volatile uint32_t startMicros = 0;
+volatile uint32_t endMicros = 0;
 
 void setup() {
-    Serial.begin(9600);  // Start serial communication
-    for (int i = 0; i < 8; i++) {
+    Serial.begin(115200);  // Start serial communication
+    for (int i = 0; i < nPins; i++) {
         pinMode(ledPins[i], OUTPUT);
     }
 }
 
-void loop() {
-    if (Serial.available()) {
-        String data = Serial.readStringUntil('\n');  // Read incoming data
-        int values[8];
-        int index = 0;
-
-        char *ptr = strtok((char*)data.c_str(), ",");
-        while (ptr != NULL && index < 8) {
-            values[index++] = constrain(atoi(ptr), 0, 255);
-            ptr = strtok(NULL, ",");
+void applyMask(byte mask) {
+    for (int i = 0; i < nPins; i++) {
+        digitalWriteFast(ledPins[i], (mask >> i) & 1 ? HIGH : LOW);
+    }
+}
+
+void applyAsciiLine(char *data) {
+    int index = 0;
+    byte mask = 0;
+    char *ptr = strtok(data, ",");
+    while (ptr != NULL && index < nPins) {
+        if (atoi(ptr) > 0) {
+            mask |= 1 << index;
         }
+        index++;
+        ptr = strtok(NULL, ",");
+    }
+    if (index == nPins) {  // Ensure all 8 values are received
+        applyMask(mask);
+    }
+}
+
+void handleUploadByte(byte b) {
+    long seg = uploadPos / 5;
+    int k = uploadPos % 5;
+    uploadSum += b;
+    if (seg < MAX_SEGMENTS) {
+        if (k == 0) {
+            segMasks[seg] = b;
+            segDurations[seg] = 0;
+        } else {
+            segDurations[seg] |= (uint32_t)b << (8 * (k - 1));
+        }
+    }
+    uploadPos++;
+    if (uploadPos == (long)uploadLen * 5) {
+        parserState = UPLOAD_CHECKSUM;
+    }
+}
 
-        if (index == 8) {  // Ensure all 8 values are received
-            for (int i = 0; i < 8; i++) {
-                // analogWrite(ledPins[i], values[i]);  // Update LED brightness
-                if (values[i] > 0){
-                  digitalWrite(ledPins[i], HIGH);  // Update LED brightness
-                }else{
-                  digitalWrite(ledPins[i], LOW);  // Update LED brightness
+void finishUpload(byte checksum) {
+    if (uploadLen > MAX_SEGMENTS) {
+        nSegments = 0;
+        Serial.println("ERR too many segments");
+    } else if (checksum != uploadSum) {
+        nSegments = 0;
+        Serial.println("ERR checksum");
+    } else {
+        nSegments = uploadLen;
+        Serial.print("UPLOADED ");
+        Serial.println(nSegments);
+    }
+}
+
+// IntervalTimer::update() only sets the period after the running one, so the interrupt that
+// applies segment i schedules the duration of segment i + 1.
+void playNext() {
+    if (playIdx < nSegments) {
+        applyMask(segMasks[playIdx]);
+        if (playIdx + 1 < nSegments) {
+            playbackTimer.update(segDurations[playIdx + 1]);
+        }
+        playIdx++;
+    } else {
+        applyMask(0);
+        endMicros = micros();
+        playbackTimer.end();
+        playing = false;
+        reportEnd = true;
+    }
+}
+
+void startPlayback() {
+    if (playing || nSegments == 0) {
+        Serial.println(playing ? "ERR already playing" : "ERR nothing uploaded");
+        return;
+    }
+    playing = true;
+    playIdx = 1;
+    startMicros = micros();
+    applyMask(segMasks[0]);
+    playbackTimer.begin(playNext, segDurations[0]);
+    if (nSegments > 1) {
+        playbackTimer.update(segDurations[1]);
+    }
+    reportStart = true;
+}
+
+void handleAsciiByte(byte b) {
+    if (b == '\n') {
+        line[lineLen] = '\0';
+        applyAsciiLine(line);
+        lineLen = 0;
+        parserState = WAIT_SYNC;
+    } else if (lineLen < (int)sizeof(line) - 1) {
+        line[lineLen++] = b;
+    }
+}
+
+void sendStatus() {
+    Serial.print("STATUS ");
+    Serial.print(nDropped);
+    Serial.print(' ');
+    Serial.println(lastSeq);
+}
+
+// Starts the binary frame of a sync byte, false for any other byte
+bool handleSyncByte(byte b) {
+    if (b == SYNC_STATE) {
+        parserState = WAIT_MASK;
+    } else if (b == SYNC_STATE_SEQ || b == SYNC_STATE_ACK) {
+        ackState = b == SYNC_STATE_ACK;
+        parserState = WAIT_SEQ;
+    } else if (b == SYNC_UPLOAD) {
+        parserState = UPLOAD_LEN_LO;
+    } else if (b == SYNC_START) {
+        startPlayback();
+        parserState = WAIT_SYNC;
+    } else if (b == SYNC_STATUS) {
+        sendStatus();
+        parserState = WAIT_SYNC;
+    } else {
+        return false;
+    }
+    return true;
+}
+
+void loop() {
+    if (reportStart) {
+        reportStart = false;
+        Serial.print("START ");
+        Serial.println(startMicros);
+    }
+    if (reportEnd) {
+        reportEnd = false;
+        Serial.print("END ");
+        Serial.println(endMicros);
+    }
+    while (Serial.available()) {
+        byte b = Serial.read();
+        switch (parserState) {
+            case WAIT_SYNC:
+                if (!handleSyncByte(b)) {
+                    lineLen = 0;
+                    parserState = ASCII_LINE;
+                    handleAsciiByte(b);
+                }
+                break;
+            case WAIT_SEQ:
+                if (hasSeq && b != (byte)(lastSeq + 1)) {
+                    nDropped += (byte)(b - lastSeq - 1);
+                }
+                lastSeq = b;
+                hasSeq = true;
+                parserState = WAIT_MASK;
+                break;
+            case WAIT_MASK:
+                if (!playing) {  // The uploaded trial owns the pins until it ends
+                    applyMask(b);
+                    if (ackState) {
+                        uint32_t appliedMicros = micros();
+                        Serial.print("ACK ");
+                        Serial.print(lastSeq);
+                        Serial.print(' ');
+                        Serial.println(appliedMicros);
+                    }
                 }
-                  
-            }
+                ackState = false;
+                parserState = WAIT_SYNC;
+                break;
+            case UPLOAD_LEN_LO:
+                uploadLen = b;
+                parserState = UPLOAD_LEN_HI;
+                break;
+            case UPLOAD_LEN_HI:
+                uploadLen |= b << 8;
+                uploadPos = 0;
+                uploadSum = 0;
+                if (playing) {
+                    playbackTimer.end();
+                    playing = false;
+                }
+                parserState = uploadLen > 0 ? UPLOAD_BODY : UPLOAD_CHECKSUM;
+                break;
+            case UPLOAD_BODY:
+                handleUploadByte(b);
+                break;
+            case UPLOAD_CHECKSUM:
+                finishUpload(b);
+                parserState = WAIT_SYNC;
+                break;
+            case ASCII_LINE:
+                // Sync bytes are never ASCII: drop the partial line so a stray byte cannot swallow binary frames
+                if (handleSyncByte(b)) {
+                    lineLen = 0;
+                } else {
+                    handleAsciiByte(b);
+                }
+                break;
         }
     }
 }
@@ -37,21 +256,21 @@ void loop() {
 //     for (int i = 0; i < 8; i++) {
 //         // analogWrite(ledPins[i], 255);  // Update LED brightness
 //         digitalWrite(ledPins[i], HIGH);  // Update LED brightness
-        
+
 //     }
 //     delay(100);
 //     for (int i = 0; i < 8; i++) {
 //         // analogWrite(ledPins[i], 255);  // Update LED brightness
 //         digitalWrite(ledPins[i], LOW);  // Update LED brightness
-        
+
 //     }
 //     delay(100);
 // //     delay(1000);
 // //     for (int i = 0; i < 8; i++) {
 // //         // analogWrite(ledPins[i], 0);  // Update LED brightness
 // //         digitalWrite(ledPins[i], LOW);  // Update LED brightness
-        
-        
+
+
 // //     }
 // //     delay(1000);
-// }
\ No newline at end of file
+// }
@@ -1,14 +1,24 @@
 import serial
+import queue
 import logging
 from typing import List
 import time
 import numpy as np
-from pylsl import StreamOutlet, StreamInfo
-from utils import perf_sleep, load_codebooks_block_2, load_codebooks_block_3, load_codebooks_block_1
+from pylsl import StreamOutlet, StreamInfo, local_clock
+from utils import perf_sleep
+from precision_timer import TIMER
+from trial_scheduler import TrialScheduler, step_offsets
+from frame_plan import FramePlan, compile_trial
+from laser_protocol import encode_state, values_to_mask, trial_segments, encode_upload, encode_start, encode_status, parse_reply
+from laser_channels import ChannelMap, LASER_CHANNEL_MAP
+from io_worker import IOWorker
+from laser_latency import AckMonitor
+from codebook_archive import get_archive
 
 class LaserController:
     """Laser is always on except right before start of a trial"""
-    def __init__(self, port: str='COM7'):
+    def __init__(self, port: str='COM7', protocol: str='binary', sequence_numbers: bool=False, hardware_playback: bool=False,
+                 channel_map: ChannelMap=LASER_CHANNEL_MAP, acknowledgements: bool=False):
         self.marker_ids = {
             'non_target': 100,
             'target': 110,
@@ -16,98 +26,208 @@ class LaserController:
             'trial_end': 210
         }
         self.port = port
+        # 'binary' sends 2-3 bytes per state (laser_protocol.py), 'ascii' the original comma separated line
+        if protocol not in ('binary', 'ascii'):
+            raise ValueError(f'Unknown protocol: {protocol}')
+        self.protocol = protocol
+        # The firmware acknowledges states with their sequence number, which needs the binary protocol
+        if acknowledgements and protocol != 'binary':
+            raise ValueError('Acknowledgements need the binary protocol')
+        self.acknowledgements = acknowledgements
+        self.sequence_numbers = sequence_numbers or acknowledgements
+        # Logical state (bit j is object j) -> wire mask and ready-to-send bytes
+        self.channel_map = channel_map
+        self._wire_bytes = channel_map.compile(protocol)
+        self._seq = 0
+        # Upload trials with upload_trial and let the firmware play them from a hardware timer
+        self.hardware_playback = hardware_playback
+        self._uploaded = None  # (plan, durations) currently in the firmware trial buffer
         self.teensy = None
+        self.last_trial_report = None  # Lateness and drift of the last trial, see TrialScheduler.report
         try:
             self.teensy = serial.Serial(port=port, baudrate=115200, timeout=1)
         except Exception as e:
             logging.warning(f"Teensy not connected: {e}")
+        # Reads all replies of the Teensy, measures write-to-onset latency and streams it to LSL
+        self.acks = AckMonitor(self.teensy) if acknowledgements and self.teensy is not None else None
 
         # Init marker stream
         info = StreamInfo(name='LaserMarkerStream', type='Marker', channel_count=1, channel_format=5, nominal_srate=0, source_id='laser_marker_stream_id')
         self.marker_outlet = StreamOutlet(info)
+        # Writes and marker pushes of the trial loops, so a stalled write never delays the next step
+        self.io = IOWorker(name='laser_io')
 
         # Turn on lasers
         self.on()
 
-    def send_lasers_values(self, values: List[int]) -> None:
+    def send_state(self, state: int, background: bool=False) -> None:
+        """Send a logical state, e.g. from FramePlan.states, bit j is object j. In the background it is
+        written by the I/O worker and the call does not wait for the serial port."""
         if self.teensy is not None:
-            # Fix laser positions that were changed
-            if 1 in values:
-                if values.index(1) == 3:
-                    values = [0, 0, 0, 0, 0, 1, 0, 0]
-                elif values.index(1) == 4:
-                    values = [0, 0, 0, 1, 0, 0, 0, 0]
-                elif values.index(1) == 5:
-                    values = [0, 0, 0, 0, 1, 0, 0, 0]
-            values = values[::-1] # Mirror the sequences so that the stimuli are correctly presented
-            data_str = ",".join(map(str, values)) + "\n"
-            self.teensy.write(data_str.encode())  # Send data
+            seq = None
+            if self.sequence_numbers and self.protocol == 'binary':
+                seq = self._seq
+                data = encode_state(int(self.channel_map.wire_masks[state]), seq=seq, ack=self.acks is not None)
+                self._seq = (self._seq + 1) & 0xFF
+                if self.acks is not None:
+                    self.acks.enqueued(seq)
+            else:
+                data = self._wire_bytes[state]
+            if background:
+                self.io.submit(self._write, data, seq)
+            else:
+                self._write(data, seq)
         else:
             logging.warning("Teensy not connected, values not sent.")
+
+    def _write(self, data: bytes, seq: int=None) -> None:
+        if self.acks is not None and seq is not None:
+            self.acks.written(seq)
+        self.teensy.write(data)
+
+    def send_lasers_values(self, values: List[int]) -> None:
+        self.send_state(values_to_mask(values))
         
     def on(self) -> None:
-        self.send_lasers_values([1] * 8)
+        self.send_state(self.channel_map.all_on)
 
     def off(self) -> None:
-        self.send_lasers_values([0] * 8)
+        self.send_state(0)
         
     def on_for(self, duration: float) -> None:
         end_time = time.perf_counter() + duration
         self.on()
-        while time.perf_counter() <= end_time:
-            pass
+        TIMER.wait_until(end_time)
         
     def off_for(self, duration: float) -> None:
         end_time = time.perf_counter() + duration
         self.off()
-        while time.perf_counter() <= end_time:
-            pass
+        TIMER.wait_until(end_time)
+
+    def _read_reply(self, keyword: str, timeout: float) -> str:
+        """Argument of the next firmware reply starting with keyword"""
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            if self.acks is not None:
+                # The AckMonitor thread owns the serial input
+                try:
+                    reply, argument = self.acks.replies.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+            else:
+                reply, argument = parse_reply(self.teensy.readline())
+            if reply == 'ERR':
+                raise RuntimeError(f'Teensy: {argument}')
+            if reply == keyword:
+                return argument
+        raise TimeoutError(f'No {keyword} reply from the Teensy')
 
-    def run_trial_erp(self, codebook: List[int], target_id: int, trial_id: int, on_duration: float=0.1, off_duration: float=0.15):
+    def upload_trial(self, plan: FramePlan, durations: list, timeout: float=2.0) -> bool:
+        """Upload all states of a trial with their step durations, e.g. [on, off], for hardware-timed playback.
+
+        Call it before the trial, e.g. during the cue. The next run_trial_erp or run_trial_cvep of the
+        same plan and durations then only sends a start command. Returns whether the trial was uploaded.
+        """
+        self._uploaded = None
+        if not self.hardware_playback or self.protocol != 'binary' or self.teensy is None:
+            return False
+        masks = self.channel_map.wire_masks[plan.states]
+        if self.acks is not None:
+            while not self.acks.replies.empty():
+                self.acks.replies.get_nowait()
+        else:
+            self.teensy.reset_input_buffer()
+        self.teensy.write(encode_upload(trial_segments(masks, durations)))
+        try:
+            n_segments = int(self._read_reply('UPLOADED', timeout))
+        except TimeoutError as e:
+            logging.warning(f"{e}, running the trial from the host.")
+            return False
+        if n_segments != len(plan) * len(durations):
+            raise RuntimeError(f'Teensy stored {n_segments} of {len(plan) * len(durations)} segments')
+        self._uploaded = (plan, list(durations))
+        return True
+
+    def _run_uploaded_trial(self, plan: FramePlan, durations: list) -> None:
+        """Start the uploaded trial and wait for the firmware to report its start and end.
+
+        Step markers are timestamped at their planned onsets from the trial start. With acknowledgements
+        the start is the firmware's START micros() mapped through the clock fit. Without them it is the
+        time of the start command, so the markers lead the real onsets by the USB latency of that command.
+        """
+        onsets = step_offsets(len(plan), durations)
+        self._uploaded = None
+        self.marker_outlet.push_sample(plan.start_sample) # Push trial start marker
+        start_time = local_clock()
+        self.teensy.write(encode_start())
+        start_us = int(self._read_reply('START', 1.0))
+        device_start_time = self.acks.host_time(start_us) if self.acks is not None else None
+        if device_start_time is not None:
+            start_time = device_start_time
+        for step_id, sample in enumerate(plan.marker_samples):
+            self.marker_outlet.push_sample(sample, start_time + onsets[step_id * len(durations)])
+        end_us = int(self._read_reply('END', onsets[-1] + 1.0))
+        self.marker_outlet.push_sample(plan.end_sample, start_time + onsets[-1])
+        duration = ((end_us - start_us) % 2**32) / 1e6
+        self.last_trial_report = {
+            'n_transitions': len(onsets) - 1,
+            'device_start_us': start_us,
+            'device_end_us': end_us,
+            'duration': duration,
+            'planned_duration': float(onsets[-1]),
+            'drift': duration - float(onsets[-1]),
+            'start_time': start_time,
+            'start_from_device_clock': device_start_time is not None,
+        }
+
+    def _is_uploaded(self, plan: FramePlan, durations: list) -> bool:
+        return self._uploaded is not None and self._uploaded[0] is plan and self._uploaded[1] == list(durations)
+
+    def run_trial_erp(self, plan: FramePlan, on_duration: float=0.1, off_duration: float=0.15):
         """Run a single trial with multiple sequences on objects using lasers"""
-        self.marker_outlet.push_sample([self.marker_ids['trial_start'] + trial_id]) # Push trial start marker
-        print('Codebook:', len(codebook))
-        for sequence in codebook:
-            is_target = sequence[target_id]
+        if self._is_uploaded(plan, [on_duration, off_duration]):
+            return self._run_uploaded_trial(plan, [on_duration, off_duration])
+        # On and off transitions run at absolute deadlines from the trial start, so overhead does not accumulate
+        scheduler = TrialScheduler(step_offsets(len(plan), [on_duration, off_duration]))
+        states, marker_samples = plan.states.tolist(), plan.marker_samples
+        io, outlet = self.io, self.marker_outlet
+        io.push_sample(outlet, plan.start_sample) # Push trial start marker
+        for transition in scheduler.run():
+            step_id, is_off = divmod(transition, 2)
+            if is_off:
+                # Turn off lasers
+                self.send_state(0, background=True)
+                continue
             # Turn on lasers
-            end_time = time.perf_counter() + on_duration
-            self.send_lasers_values(sequence)
-            if is_target == 1:
-                self.marker_outlet.push_sample([self.marker_ids['target'] + target_id]) # Push target marker
-            elif is_target == 0:
-                self.marker_outlet.push_sample([self.marker_ids['non_target'] + target_id]) # Push non-target marker
-            else:
-                ValueError(f'Unknown target value: {is_target}')
-            while time.perf_counter() <= end_time:
-                pass
-            # Turn off lasers
-            end_time = time.perf_counter() + off_duration
-            self.off()
-            while time.perf_counter() <= end_time:
-                pass
+            self.send_state(states[step_id], background=True)
+            io.push_sample(outlet, marker_samples[step_id]) # Push target or non-target marker
 
-        self.marker_outlet.push_sample([self.marker_ids['trial_end'] + trial_id])
+        io.push_sample(outlet, plan.end_sample)
+        io.flush()
+        self.last_trial_report = {**scheduler.report(), 'io': io.stats()}
+        if self.acks is not None:
+            self.last_trial_report['latency'] = self.acks.stats()
 
     
-    def run_trial_cvep(self, codebook: List[int], target_id: int, trial_id: int, on_duration: float=1 / 60):
+    def run_trial_cvep(self, plan: FramePlan, on_duration: float=1 / 60):
         """Run a single trial with multiple sequences on objects using lasers"""
-        self.marker_outlet.push_sample([self.marker_ids['trial_start'] + trial_id]) # Push trial start marker
-        for sequence in codebook:
-            is_target = sequence[target_id]
+        if self._is_uploaded(plan, [on_duration]):
+            return self._run_uploaded_trial(plan, [on_duration])
+        scheduler = TrialScheduler(step_offsets(len(plan), [on_duration]))
+        states, marker_samples = plan.states.tolist(), plan.marker_samples
+        io, outlet = self.io, self.marker_outlet
+        io.push_sample(outlet, plan.start_sample) # Push trial start marker
+        for step_id in scheduler.run():
             # Turn on lasers
-            end_time = time.perf_counter() + on_duration
-            self.send_lasers_values(sequence)
-            if is_target == 1:
-                self.marker_outlet.push_sample([self.marker_ids['target'] + target_id]) # Push target marker
-            elif is_target == 0:
-                self.marker_outlet.push_sample([self.marker_ids['non_target'] + target_id]) # Push non-target marker
-            else:
-                ValueError(f'Unknown target value: {is_target}')
-            while time.perf_counter() <= end_time:
-                pass
+            self.send_state(states[step_id], background=True)
+            io.push_sample(outlet, marker_samples[step_id]) # Push target or non-target marker
 
-        self.marker_outlet.push_sample([self.marker_ids['trial_end'] + trial_id])
+        io.push_sample(outlet, plan.end_sample)
+        io.flush()
         self.off()
+        self.last_trial_report = {**scheduler.report(), 'io': io.stats()}
+        if self.acks is not None:
+            self.last_trial_report['latency'] = self.acks.stats()
         
     def test_quick_flash(self):
         quick_flash_wait_duration = (0.75, 1)
@@ -121,44 +241,58 @@ class LaserController:
                 end_time = time.perf_counter() + 1 / 60
                 self.send_lasers_values(seq)
                 self.marker_outlet.push_sample([self.marker_ids['target'] + 1]) # Push target marker
-                while time.perf_counter() <= end_time:
-                    pass
+                TIMER.wait_until(end_time)
                 
             self.marker_outlet.push_sample([self.marker_ids['trial_end'] + trial_id]) # Push trial start marker
         
     
     def test_erp(self, n_trials=8):
         """Test Run ERP protocol"""
-        codebook = load_codebooks_block_2()[0].astype(int).tolist()
-        codebook = load_codebooks_block_1()[0].astype(int).tolist()
+        codebook = get_archive().load('condition_2')[0]
+        codebook = get_archive().load('condition_1')[0]
 
         trial_run_times = []
         for trial_id in range(n_trials):
+            plan = compile_trial(codebook, target_id=0, trial_id=trial_id, marker_ids=self.marker_ids)
+            self.upload_trial(plan, [0.1, 0.15])
             start_time = time.perf_counter()
-            print(len(codebook))
-            self.run_trial_erp(codebook, target_id=0, trial_id=trial_id, on_duration=0.1, off_duration=0.15)
+            print(len(plan))
+            self.run_trial_erp(plan, on_duration=0.1, off_duration=0.15)
             elapsed_time = time.perf_counter() - start_time
             trial_run_times.append(elapsed_time)
+            print('Trial schedule:', self.last_trial_report)
             perf_sleep(3)
 
         print('Trial run times:', trial_run_times)
         print('Mean trial run time (should be 12):', np.mean(trial_run_times))
+        print('Timer wake-up stats:', TIMER.stats())
+        if self.acks is not None:
+            print('Onset latency stats:', self.acks.stats())
+        if self.sequence_numbers:
+            print('Firmware status:', self.status())
 
     def test_cvep(self, n_trials=8):
         """Test Run ERP protocol"""
-        codebook = load_codebooks_block_3()[0].astype(int).tolist()
-        codebook = codebook[:720]
+        codebook = get_archive().load('condition_3')[0]
 
         trial_run_times = []
         for trial_id in range(n_trials):
+            plan = compile_trial(codebook, target_id=0, trial_id=trial_id, marker_ids=self.marker_ids, n_steps=720)
+            self.upload_trial(plan, [1/60])
             start_time = time.perf_counter()
-            self.run_trial_cvep(codebook, target_id=0, trial_id=trial_id, on_duration=1/60)
+            self.run_trial_cvep(plan, on_duration=1/60)
             elapsed_time = time.perf_counter() - start_time
             trial_run_times.append(elapsed_time)
+            print('Trial schedule:', self.last_trial_report)
             perf_sleep(3)
 
         print('Trial run times:', trial_run_times)
         print('Mean trial run time (should be 12):', np.mean(trial_run_times))
+        print('Timer wake-up stats:', TIMER.stats())
+        if self.acks is not None:
+            print('Onset latency stats:', self.acks.stats())
+        if self.sequence_numbers:
+            print('Firmware status:', self.status())
 
     def test_quick_flash(self):
         from utils import random_wait
@@ -169,13 +303,23 @@ class LaserController:
                 end_time = time.perf_counter() + 1/60
                 self.send_lasers_values(seq)
                 self.marker_outlet.push_sample([self.marker_ids['trial_end'] + trial_id])
-                while time.perf_counter() <= end_time:
-                    pass
+                TIMER.wait_until(end_time)
                 self.off()
                 random_wait(0.75, 1)
             perf_sleep(3)
 
+    def status(self, timeout: float=1.0) -> dict:
+        """States the firmware lost according to the sequence numbers, and the last sequence number it saw"""
+        if self.teensy is None:
+            return None
+        self.teensy.write(encode_status())
+        n_dropped, last_seq = map(int, self._read_reply('STATUS', timeout).split())
+        return {'n_dropped': n_dropped, 'last_seq': last_seq}
+
     def close(self) -> None:
+        self.io.close()
+        if self.acks is not None:
+            self.acks.close()
         if self.teensy is not None:
             self.teensy.close()
 
@@ -192,7 +336,7 @@ class LaserController:
                 break
 
 if __name__ == '__main__':
-    lasers = LaserController()
+    lasers = LaserController(acknowledgements=True)
     lasers.off()
     
     _ = input('Press any key to continue.\n')
@@ -0,0 +1,82 @@
+import hashlib
+import numpy as np
+from scipy import sparse
+
+# Object layouts are sparse, symmetric boolean adjacency matrices (n_objs x n_objs).
+# None everywhere in the generator means the original single horizontal row of objects.
+
+
+def row_layout(n_objs: int) -> sparse.csr_matrix:
+    """Objects in one row, j and j+1 are neighbors"""
+    return grid_layout(1, n_objs)
+
+def grid_layout(n_rows: int, n_cols: int, diagonal: bool=False) -> sparse.csr_matrix:
+    """Objects on an n_rows x n_cols grid numbered row by row, e.g. a 6x6 speller matrix.
+    Neighbors share an edge, or also a corner if diagonal."""
+    idc = np.arange(n_rows * n_cols).reshape(n_rows, n_cols)
+    pairs = [
+        (idc[:, :-1], idc[:, 1:]),
+        (idc[:-1, :], idc[1:, :]),
+    ]
+    if diagonal:
+        pairs += [(idc[:-1, :-1], idc[1:, 1:]), (idc[:-1, 1:], idc[1:, :-1])]
+    return graph_layout(n_rows * n_cols, [(a.ravel(), b.ravel()) for a, b in pairs])
+
+def graph_layout(n_objs: int, edges) -> sparse.csr_matrix:
+    """Arbitrary layout from edges, either a list of (i, j) pairs or a list of (i_array, j_array)"""
+    edges = list(edges)
+    if edges and np.ndim(edges[0][0]) == 0:
+        edges = [(np.array([i for i, _ in edges]), np.array([j for _, j in edges]))]
+    rows = np.concatenate([np.asarray(i) for i, _ in edges] + [np.asarray(j) for _, j in edges]) if edges else np.zeros(0, int)
+    cols = np.concatenate([np.asarray(j) for _, j in edges] + [np.asarray(i) for i, _ in edges]) if edges else np.zeros(0, int)
+    adjacency = sparse.csr_matrix((np.ones(rows.size, dtype=bool), (rows, cols)), shape=(n_objs, n_objs))
+    adjacency.sum_duplicates()
+    return adjacency
+
+def parse_grid(grid: str) -> tuple:
+    """'6x6' -> (6, 6)"""
+    n_rows, n_cols = grid.lower().split('x')
+    return int(n_rows), int(n_cols)
+
+def layout_key(adjacency: sparse.csr_matrix) -> str:
+    """Stable hash of a layout, for cache and checkpoint keys"""
+    if adjacency is None:
+        return None
+    adjacency = sparse.csr_matrix(adjacency)
+    adjacency.sort_indices()
+    digest = hashlib.sha1(np.int64(adjacency.shape[0]).tobytes())
+    digest.update(adjacency.indptr.astype(np.int64).tobytes())
+    digest.update(adjacency.indices.astype(np.int64).tobytes())
+    return digest.hexdigest()
+
+def has_adjacent_highlights(codebook: np.ndarray, adjacency: sparse.csr_matrix) -> bool:
+    """True if any step (row) highlights two neighboring objects"""
+    x = np.asarray(codebook) == 1
+    # (x @ A)[t, j] counts highlighted neighbors of object j at step t
+    return bool(((adjacency.T @ x.T).T.astype(bool) & x).any())
+
+def adjacent_pairs(picks: np.ndarray, adjacency: sparse.csr_matrix) -> np.ndarray:
+    """For candidate rows given as object indices (n_candidates, n_highlights), True where two picks are neighbors"""
+    n_candidates, n_highlights = picks.shape
+    n_objs = adjacency.shape[0]
+    picked = np.zeros((n_candidates, n_objs), dtype=bool)
+    candidate = np.repeat(np.arange(n_candidates), n_highlights)
+    picks = picks.ravel()
+    picked[candidate, picks] = True
+    # Walk the CSR neighbor lists of all picks at once, O(edges of the picks) instead of O(n_highlights^2)
+    starts = adjacency.indptr[picks]
+    degrees = adjacency.indptr[picks + 1] - starts
+    offsets = np.arange(degrees.sum()) - np.repeat(np.cumsum(degrees) - degrees, degrees) + np.repeat(starts, degrees)
+    hits = picked[np.repeat(candidate, degrees), adjacency.indices[offsets]]
+    return np.bincount(np.repeat(candidate, degrees)[hits], minlength=n_candidates) > 0
+
+def count_neighbor_paths(codebook: np.ndarray, adjacency: sparse.csr_matrix) -> int:
+    """Layout version of compute_diag_neighbors: flashes on j, k, l at steps (rows) t, t+1, t+2 where k is
+    a neighbor of j and l a neighbor of k other than j. On row_layout these are exactly the diagonal runs."""
+    x = (np.asarray(codebook) == 1).astype(np.int64)
+    if x.shape[0] < 3:
+        return 0
+    before = (adjacency @ x[:-2].T).T  # Highlighted neighbors of every object one step earlier
+    after = (adjacency @ x[2:].T).T  # and one step later
+    back = (adjacency @ (x[:-2] * x[2:]).T).T  # Neighbors highlighted at both, paths that turn back (l = j)
+    return int((x[1:-1] * (before * after - back)).sum())
@@ -6,7 +6,8 @@ import numpy as np
 import pandas as pd
 
 from utils import perf_sleep
-from utils import load_codebooks_block_1, load_codebooks_block_2, load_codebooks_block_3
+from codebook_archive import get_archive
+from frame_plan import compile_trial
 
 from lasers import LaserController
 from button_box import ButtonBoxController
@@ -23,9 +24,10 @@ class StimController:
         np.random.seed(random_seed)
         
         # Experiment global settings
-        self.codebook_kolkhorst = load_codebooks_block_1()
-        self.codebook_fast_erp = load_codebooks_block_2()
-        self.codebook_cvep = load_codebooks_block_3()
+        codebook_archive = get_archive()
+        self.codebook_kolkhorst = codebook_archive.load('condition_1')
+        self.codebook_fast_erp = codebook_archive.load('condition_2')
+        self.codebook_cvep = codebook_archive.load('condition_3')
         
         self.objects = {
             0: 'bottle', 
@@ -82,8 +84,10 @@ class StimController:
         self.cvep_on_frames = 1
         self.screen_warmup_duration = self.trial_rest_duration  # seconds
         
-        # Init laser controller
-        self.laser_controller = LaserController()
+        # Init laser controller. With hardware playback trials are uploaded during the cue and played from the
+        # Teensy's hardware timer, off until it has been validated on the rig
+        self.laser_hardware_playback = False
+        self.laser_controller = LaserController(hardware_playback=self.laser_hardware_playback)
 
         # Init button box controller
         self.button_box_controller = ButtonBoxController()
@@ -174,42 +178,45 @@ class StimController:
         ref_id = np.random.choice([i for i in range(self.n_objs) if i!=target_id])
         ref_obj = self.objects[ref_id]
         
-        # Run trial based on mode        
+        # Run trial based on mode. Frame plans are compiled before the cue, outside the timing loops
         if condition == 0:
-            codebook = list(self.codebook_kolkhorst[run_id])
+            plan = compile_trial(self.codebook_kolkhorst[run_id], target_id, trial_id, marker_ids=self.laser_controller.marker_ids)
             perf_sleep(1)
             self.audio_controller.cue_audio(ref_obj=ref_obj, target_obj=target_obj, mode=mode)
             self.laser_controller.off()
+            self.laser_controller.upload_trial(plan, [self.erp_on_duration, self.erp_off_duration])
             perf_sleep(2)
-            self.laser_controller.run_trial_erp(codebook, target_id, trial_id=trial_id, on_duration=self.erp_on_duration, off_duration=self.erp_off_duration)
+            self.laser_controller.run_trial_erp(plan, on_duration=self.erp_on_duration, off_duration=self.erp_off_duration)
         elif condition == 1:
-            codebook = list(self.codebook_fast_erp[run_id])
+            plan = compile_trial(self.codebook_fast_erp[run_id], target_id, trial_id, marker_ids=self.laser_controller.marker_ids)
             perf_sleep(1)
             self.audio_controller.cue_audio(ref_obj=ref_obj, target_obj=target_obj, mode=mode)
             self.laser_controller.off()
+            self.laser_controller.upload_trial(plan, [self.erp_on_duration, self.erp_off_duration])
             perf_sleep(2)
-            self.laser_controller.run_trial_erp(codebook, target_id, trial_id=trial_id, on_duration=self.erp_on_duration, off_duration=self.erp_off_duration)
+            self.laser_controller.run_trial_erp(plan, on_duration=self.erp_on_duration, off_duration=self.erp_off_duration)
         elif condition == 2:
-            codebook = list(self.codebook_cvep[run_id])
+            plan = compile_trial(self.codebook_cvep[run_id], target_id, trial_id, marker_ids=self.laser_controller.marker_ids)
             perf_sleep(1)
             self.audio_controller.cue_audio(ref_obj=ref_obj, target_obj=target_obj, mode=mode)
             self.laser_controller.off()
+            self.laser_controller.upload_trial(plan, [1/self.refresh_rate])
             perf_sleep(2)
-            self.laser_controller.run_trial_cvep(codebook=codebook, target_id=target_id, trial_id=trial_id, on_duration=1/self.refresh_rate)
+            self.laser_controller.run_trial_cvep(plan, on_duration=1/self.refresh_rate)
         elif condition == 3:
-            codebook = list(self.codebook_fast_erp[run_id])
             target_id = self.new_pictograms_order[target_id]
+            plan = compile_trial(self.codebook_fast_erp[run_id], target_id, trial_id, marker_ids=self.screen.marker_ids)
             self.screen.screen_warmup(1)
             self.audio_controller.cue_audio(ref_obj=ref_obj, target_obj=target_obj, mode=mode)
             self.screen.screen_warmup(2)
-            self.screen.run_trial_erp(codebook, target_id=target_id, trial_id=trial_id, n_stim_on_frames=self.erp_on_frames, n_stim_off_frames=self.erp_off_frames)
+            self.screen.run_trial_erp(plan, n_stim_on_frames=self.erp_on_frames, n_stim_off_frames=self.erp_off_frames)
         elif condition == 4:
-            codebook = list(self.codebook_cvep[run_id])
             target_id = self.new_pictograms_order[target_id]
+            plan = compile_trial(self.codebook_cvep[run_id], target_id, trial_id, marker_ids=self.screen.marker_ids)
             self.screen.screen_warmup(1)
             self.audio_controller.cue_audio(ref_obj=ref_obj, target_obj=target_obj, mode=mode)
             self.screen.screen_warmup(2)
-            self.screen.run_trial_cvep(codebook, target_id=target_id, trial_id=trial_id)
+            self.screen.run_trial_cvep(plan)
         else:
             raise ValueError(f'Condition doesnt exist: {condition}')
         
@@ -0,0 +1,70 @@
+import time
+import collections
+import numpy as np
+
+
+class PrecisionTimer:
+    """Waits that sleep most of the time and only busy-wait right before the deadline.
+
+    time.sleep wakes up late by an OS dependent amount (up to ~16 ms on a default Windows timer), so
+    the timer sleeps until spin_margin before the deadline and spins for the rest. The margin follows
+    the measured oversleep: a high quantile of the recent wake-up delays times a safety factor, clipped
+    to [min_margin, max_margin]. Errors (actual - deadline) of every wait are kept for stats().
+    """
+    def __init__(
+            self, spin_margin: float=0.002, min_margin: float=0.0002, max_margin: float=0.02,
+            quantile: float=0.99, safety: float=1.5, history: int=500
+        ):
+        self.spin_margin = spin_margin
+        self.min_margin = min_margin
+        self.max_margin = max_margin
+        self.quantile = quantile
+        self.safety = safety
+        self._oversleeps = collections.deque(maxlen=history)
+        self._errors = collections.deque(maxlen=history)
+        self._n_late = 0
+
+    def wait_until(self, deadline: float) -> float:
+        """Block until time.perf_counter() reaches deadline, returns how late it woke up in seconds"""
+        now = time.perf_counter()
+        sleep_duration = deadline - now - self.spin_margin
+        if sleep_duration > 0:
+            time.sleep(sleep_duration)
+            woke_up = time.perf_counter()
+            self._oversleeps.append(woke_up - (now + sleep_duration))
+            if woke_up > deadline:
+                # The spin margin did not cover this oversleep
+                self._n_late += 1
+            self._adapt()
+        now = time.perf_counter()
+        while now < deadline:
+            now = time.perf_counter()
+        error = now - deadline
+        self._errors.append(error)
+        return error
+
+    def sleep(self, duration: float) -> float:
+        return self.wait_until(time.perf_counter() + duration)
+
+    def _adapt(self) -> None:
+        margin = self.safety * np.quantile(self._oversleeps, self.quantile)
+        self.spin_margin = float(np.clip(margin, self.min_margin, self.max_margin))
+
+    def stats(self) -> dict:
+        """Wake-up error and oversleep statistics over the recent waits, in seconds"""
+        errors = np.array(self._errors)
+        oversleeps = np.array(self._oversleeps)
+        return {
+            'n_waits': len(errors),
+            'spin_margin': self.spin_margin,
+            'n_late': self._n_late,
+            'error_mean': float(errors.mean()) if len(errors) else np.nan,
+            'error_max': float(errors.max()) if len(errors) else np.nan,
+            'error_p99': float(np.quantile(errors, 0.99)) if len(errors) else np.nan,
+            'oversleep_mean': float(oversleeps.mean()) if len(oversleeps) else np.nan,
+            'oversleep_max': float(oversleeps.max()) if len(oversleeps) else np.nan,
+        }
+
+
+# Shared by perf_sleep and the stimulus loops so the margin adapts to all waits of the process
+TIMER = PrecisionTimer()
@@ -0,0 +1,104 @@
+import os
+import glob
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Rendering is a separate stage from generation: figures are built with the object oriented API on an
+# Agg canvas, so workers never touch pyplot state or a GUI backend.
+MANIFEST_NAME = '.render_manifest.json'
+
+
+def _file_hash(fpath: str) -> str:
+    with open(fpath, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _save_figure(fig: Figure, png_path: str) -> None:
+    FigureCanvasAgg(fig)
+    fig.tight_layout()
+    fig.savefig(png_path, format='png')
+
+def render_codebook(npy_path: str, png_path: str) -> str:
+    fig = Figure(figsize=(10, 7))
+    ax = fig.add_subplot()
+    ax.imshow(np.load(npy_path))
+    _save_figure(fig, png_path)
+    return png_path
+
+def render_montage(npy_paths: list, png_path: str) -> str:
+    """All codebooks of a condition in one image"""
+    n_cols = int(np.ceil(np.sqrt(len(npy_paths))))
+    n_rows = int(np.ceil(len(npy_paths) / n_cols))
+    fig = Figure(figsize=(5 * n_cols, 3.5 * n_rows))
+    for i, npy_path in enumerate(npy_paths):
+        ax = fig.add_subplot(n_rows, n_cols, i + 1)
+        ax.imshow(np.load(npy_path))
+        ax.set_title(os.path.basename(npy_path))
+    _save_figure(fig, png_path)
+    return png_path
+
+def render_condition(codebook_dir: str, image_dir: str, montage: bool=False, n_workers: int=1, force: bool=False) -> list:
+    """Render every codebook_obj_*.npy of a condition, skipping ones whose .npy did not change.
+
+    Source hashes of the last render are kept in a manifest next to the images.
+    Returns the paths of the images that were (re)rendered.
+    """
+    os.makedirs(image_dir, exist_ok=True)
+    manifest_path = os.path.join(image_dir, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    npy_paths = sorted(glob.glob(f'{codebook_dir}/codebook_obj_*.npy'))
+    hashes = {os.path.basename(npy_path): _file_hash(npy_path) for npy_path in npy_paths}
+    jobs = []
+    if montage:
+        png_path = os.path.join(image_dir, 'montage.png')
+        if manifest.get('montage.png') != hashes or not os.path.exists(png_path):
+            jobs.append((render_montage, npy_paths, png_path))
+        manifest['montage.png'] = hashes
+    else:
+        for npy_path in npy_paths:
+            name = os.path.basename(npy_path)
+            png_path = os.path.join(image_dir, os.path.splitext(name)[0] + '.png')
+            if manifest.get(name) != hashes[name] or not os.path.exists(png_path):
+                jobs.append((render_codebook, npy_path, png_path))
+            manifest[name] = hashes[name]
+
+    if n_workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(*job) for job in jobs]
+            rendered = [future.result() for future in futures]
+    else:
+        rendered = [job[0](*job[1:]) for job in jobs]
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return rendered
+
+def render_all(output: str='.', montage: bool=False, n_workers: int=1, force: bool=False) -> list:
+    rendered = []
+    for condition in ['condition_1', 'condition_2']:
+        rendered += render_condition(
+            f'{output}/codebooks/{condition}', f'{output}/images/codebook_{condition}',
+            montage=montage, n_workers=n_workers, force=force
+        )
+    return rendered
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Render codebook images for the generated .npy files')
+    parser.add_argument('--output', type=str, default='.', help='directory holding codebooks/ and images/')
+    parser.add_argument('--montage', action='store_true', help='one image per condition instead of one per codebook')
+    parser.add_argument('--n-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--force', action='store_true', help='render even if the .npy did not change')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    rendered = render_all(**vars(parse_args()))
+    print(f'Rendered {len(rendered)} images')
@@ -0,0 +1,165 @@
+import math
+import itertools
+import numpy as np
+from layouts import layout_key, adjacent_pairs
+
+
+class RowGraph:
+    """Precomputed index of the valid rows and of which rows may follow which.
+
+    A row highlights n_obj_highlights objects that are not neighbors (j and j+1, or a sparse adjacency
+    from layouts.py). Row b may follow row a if they share no object, and under the n_off_intervals
+    refractory rule a row may follow a window of rows if it may follow every row in it. Codebooks are
+    random walks over this graph: every step draws directly from the allowed rows, nothing is rejected.
+    Walks and counts are over windows of row ids, id -1 is an empty slot (e.g. the zero init row).
+    Some windows have no successor at all (the free objects are all neighbors), walks steer clear of those.
+    The compatibility table is quadratic in the valid rows, so layouts with more than max_rows are refused.
+    The liveness memo is bounded by max_memo windows and restarts with every walk.
+    """
+    def __init__(self, n_objs: int, n_obj_highlights: int, n_off_intervals: int, adjacency=None, max_rows: int=5000, max_memo: int=100000):
+        self.n_objs = n_objs
+        self.n_obj_highlights = n_obj_highlights
+        self.n_off_intervals = n_off_intervals
+        n_candidates = math.comb(n_objs, n_obj_highlights)
+        if n_candidates > 100 * max_rows:
+            raise ValueError(f'{n_candidates} candidate rows, too many to index (use the random method instead)')
+
+        # Valid rows in lexicographic order of their highlighted indices
+        candidates = np.array(list(itertools.combinations(range(n_objs), n_obj_highlights)), dtype=np.int64)
+        candidates = candidates.reshape(n_candidates, n_obj_highlights)
+        if adjacency is None:
+            valid = ~(np.diff(candidates, axis=1) == 1).any(axis=1)
+        else:
+            valid = ~adjacent_pairs(candidates, adjacency)
+        self.row_idc = candidates[valid]
+        if len(self.row_idc) > max_rows:
+            raise ValueError(f'{len(self.row_idc)} valid rows, more than max_rows={max_rows} (use the random method instead)')
+        self.rows = np.zeros((len(self.row_idc), n_objs))
+        self.rows[np.arange(len(self.row_idc))[:, None], self.row_idc] = 1
+        self._ids = {tuple(idc): i for i, idc in enumerate(self.row_idc.tolist())}
+
+        # compatible[a, b]: row b may follow row a. The extra last line is the empty slot (-1), which allows all.
+        no_overlap = (self.rows @ self.rows.T) == 0
+        self.compatible = np.vstack((no_overlap, np.ones((1, len(self.rows)), dtype=bool)))
+        self._n_sequences = {}
+        self.max_memo = max_memo
+        self._alive = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def row_id(self, row: np.ndarray) -> int:
+        idc = tuple(np.flatnonzero(np.asarray(row) == 1).tolist())
+        if not idc:
+            return -1
+        if idc not in self._ids:
+            raise ValueError(f'Not a valid row: {row}')
+        return self._ids[idc]
+
+    def initial_window(self, init_codebook: np.ndarray=None) -> tuple:
+        window = [-1] * self.n_off_intervals
+        if init_codebook is not None and self.n_off_intervals > 0:
+            window += [self.row_id(row) for row in init_codebook[-self.n_off_intervals:]]
+        return tuple(window[len(window) - self.n_off_intervals:])
+
+    def successors(self, window: tuple) -> np.ndarray:
+        """Ids of the rows allowed after a window, in lexicographic order"""
+        if not window:
+            return np.arange(len(self.rows))
+        return np.flatnonzero(self.compatible[list(window)].all(axis=0))
+
+    def _step(self, window: tuple, row_id: int) -> tuple:
+        return (window + (int(row_id),))[1:] if self.n_off_intervals > 0 else window
+
+    def is_alive(self, window: tuple, _path: set=None) -> bool:
+        """True if an endless walk can start from window, i.e. it does not run into a window without successors.
+
+        Depth-first search for a cycle, memoized. A window that is still on the search path closes a cycle.
+        """
+        if window in self._alive:
+            return self._alive[window]
+        path = set() if _path is None else _path
+        if window in path:
+            return True
+        path.add(window)
+        alive = any(self.is_alive(self._step(window, row_id), path) for row_id in self.successors(window))
+        path.discard(window)
+        self._alive[window] = alive
+        return alive
+
+    def walk(self, init_codebook: np.ndarray=None, rng: np.random.Generator=None):
+        """Endless stream of row ids, each drawn uniformly from the allowed rows that do not lead into a dead end"""
+        if rng is None:
+            rng = np.random.default_rng()
+        window = self.initial_window(init_codebook)
+        self._alive.clear()
+        if not self.is_alive(window):
+            raise ValueError(f'Every walk after {window} runs into a dead end')
+        while True:
+            if len(self._alive) > self.max_memo:
+                self._alive.clear()
+            # Random order over the allowed rows, the first one with a live window is a uniform draw among those
+            for row_id in rng.permutation(self.successors(window)):
+                new_window = self._step(window, row_id)
+                if self.is_alive(new_window):
+                    break
+            window = new_window
+            yield row_id
+
+    def walk_block(self, n_min_highlights: int, init_codebook: np.ndarray=None, rng: np.random.Generator=None) -> np.ndarray:
+        """One repetition block: walk until every object was highlighted n_min_highlights times"""
+        counts = np.zeros(self.n_objs, dtype=np.int64)
+        row_ids = []
+        for row_id in self.walk(init_codebook, rng=rng):
+            row_ids.append(row_id)
+            counts[self.row_idc[row_id]] += 1
+            if counts.min() >= n_min_highlights:
+                return self.rows[row_ids]
+
+    def _count(self, window: tuple, length: int) -> int:
+        if length == 0:
+            return 1
+        key = (window, length)
+        if key not in self._n_sequences:
+            self._n_sequences[key] = sum(self._count(self._step(window, row_id), length - 1) for row_id in self.successors(window))
+        return self._n_sequences[key]
+
+    def count_sequences(self, length: int, init_codebook: np.ndarray=None) -> int:
+        """Exact number of valid sequences of length rows after init_codebook (memoized on the window)"""
+        return self._count(self.initial_window(init_codebook), length)
+
+    def sequences(self, length: int, init_codebook: np.ndarray=None):
+        """Yield every valid sequence of length rows in lexicographic order"""
+        stack = [(self.initial_window(init_codebook), [])]
+        while stack:
+            window, row_ids = stack.pop()
+            if len(row_ids) == length:
+                yield self.rows[row_ids]
+                continue
+            for row_id in self.successors(window)[::-1]:
+                stack.append((self._step(window, row_id), row_ids + [row_id]))
+
+    def sample_sequence(self, length: int, init_codebook: np.ndarray=None, rng: np.random.Generator=None) -> np.ndarray:
+        """Draw one of the count_sequences(length) sequences uniformly"""
+        if rng is None:
+            rng = np.random.default_rng()
+        window = self.initial_window(init_codebook)
+        if self._count(window, length) == 0:
+            raise ValueError(f'No valid sequence of {length} rows')
+        row_ids = []
+        for steps_left in range(length, 0, -1):
+            allowed = self.successors(window)
+            weights = np.array([self._count(self._step(window, row_id), steps_left - 1) for row_id in allowed], dtype=float)
+            row_id = allowed[rng.choice(allowed.size, p=weights / weights.sum())]
+            row_ids.append(row_id)
+            window = self._step(window, row_id)
+        return self.rows[row_ids]
+
+
+_ROW_GRAPHS = {}
+
+def get_row_graph(n_objs: int, n_obj_highlights: int, n_off_intervals: int, adjacency=None) -> RowGraph:
+    key = (n_objs, n_obj_highlights, n_off_intervals, layout_key(adjacency))
+    if key not in _ROW_GRAPHS:
+        _ROW_GRAPHS[key] = RowGraph(n_objs, n_obj_highlights, n_off_intervals, adjacency)
+    return _ROW_GRAPHS[key]
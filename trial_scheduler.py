@@ -0,0 +1,52 @@
+import time
+import numpy as np
+from precision_timer import TIMER, PrecisionTimer
+
+
+def step_offsets(n_steps: int, durations: list) -> np.ndarray:
+    """Transition times from the trial start when every step runs through durations, e.g. [on, off].
+
+    Returns n_steps * len(durations) + 1 offsets, the last one is the end of the trial.
+    """
+    return np.concatenate(([0.0], np.cumsum(np.tile(durations, n_steps))))
+
+
+class TrialScheduler:
+    """Runs the transitions of a trial at absolute deadlines, start_time + offsets.
+
+    Deadlines never depend on when the previous transition actually ran, so serial writes and
+    marker pushes do not add up over a trial: a late transition only delays itself.
+    """
+    def __init__(self, offsets: np.ndarray, timer: PrecisionTimer=TIMER):
+        self.offsets = np.asarray(offsets, dtype=float)
+        self.timer = timer
+        self.start_time = None
+        self.actual_times = np.full(len(self.offsets), np.nan)
+
+    def run(self, start_time: float=None):
+        """Yield the index of every transition once its deadline passed, then wait for the end of the trial"""
+        self.start_time = time.perf_counter() if start_time is None else start_time
+        deadlines = self.start_time + self.offsets
+        for i in range(len(deadlines) - 1):
+            self.timer.wait_until(deadlines[i])
+            self.actual_times[i] = time.perf_counter()
+            yield i
+        self.timer.wait_until(deadlines[-1])
+        self.actual_times[-1] = time.perf_counter()
+
+    @property
+    def lateness(self) -> np.ndarray:
+        """Seconds every transition started after its deadline"""
+        return self.actual_times - (self.start_time + self.offsets)
+
+    def report(self) -> dict:
+        lateness = self.lateness[:-1]
+        return {
+            'n_transitions': len(lateness),
+            'duration': float(self.actual_times[-1] - self.start_time),
+            'planned_duration': float(self.offsets[-1]),
+            'drift': float(self.lateness[-1]),
+            'lateness_mean': float(np.nanmean(lateness)),
+            'lateness_p99': float(np.nanquantile(lateness, 0.99)),
+            'lateness_max': float(np.nanmax(lateness)),
+        }
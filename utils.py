@@ -1,48 +1,50 @@
-import time
 import numpy as np
 import logging
 import glob
+from codebook_bits import pack_codebook
+from precision_timer import TIMER
 
-def load_codebook(filepath: str) -> np.ndarray:
+def load_codebook(filepath: str, packed: bool=False) -> np.ndarray:
+    """Load a (n_objs, n_steps) file as (n_steps, n_objs), or as (n_steps,) bitmasks if packed"""
     codebook = np.load(filepath).T
+    if packed:
+        codebook = pack_codebook(codebook)
     return codebook
 
-def load_codebooks_block_1(path: str='./codebooks/condition_1') -> np.ndarray:
+def load_codebooks_block_1(path: str='./codebooks/condition_1', packed: bool=False) -> np.ndarray:
     """Block 1 aka Henrich's codebook"""
     codebooks = []
     fpaths = sorted(glob.glob(f'{path}/codebook_obj_*.npy'))
     for fpath in fpaths:
-        codebook = load_codebook(fpath)
+        codebook = load_codebook(fpath, packed=packed)
         codebooks.append(codebook)
     codebooks = np.array(codebooks)
     logging.info(f'Codebooks loaded. shape: {np.array(codebooks).shape}')
     return codebooks
     
-def load_codebooks_block_2(path: str='./codebooks/condition_2') -> np.ndarray:
+def load_codebooks_block_2(path: str='./codebooks/condition_2', packed: bool=False) -> np.ndarray:
     """Block 2 aka custom codebook"""
     codebooks = []
     fpaths = sorted(glob.glob(f'{path}/codebook_obj_*.npy'))
     for fpath in fpaths:
-        codebook = load_codebook(fpath)
+        codebook = load_codebook(fpath, packed=packed)
         codebooks.append(codebook)
     codebooks = np.array(codebooks)
     logging.info(f'Codebooks loaded. shape: {np.array(codebooks).shape}')
     return codebooks
 
-def load_codebooks_block_3(fpath: str='./codebooks/condition_3/mseq_61_shift_8.npy', n_reps: int=12, n_objs: int=8) -> np.ndarray:
+def load_codebooks_block_3(fpath: str='./codebooks/condition_3/mseq_61_shift_8.npy', n_reps: int=12, n_objs: int=8, packed: bool=False) -> np.ndarray:
     """Block 2 aka custom cVEP"""
-    codebooks = []
-    codebook = load_codebook(fpath)
-    # Select 8 codebooks
-    codebook = np.vstack([codebook] * n_reps)
-    codebooks = np.array([codebook] * n_objs)
-    logging.info(f'Codebooks loaded. shape: {np.array(codebooks).shape}')
+    codebook = load_codebook(fpath, packed=packed)
+    codebook = np.tile(codebook, (n_reps,) + (1,) * (codebook.ndim - 1))
+    # Select 8 codebooks, read-only views of the same array
+    codebooks = np.broadcast_to(codebook, (n_objs,) + codebook.shape)
+    logging.info(f'Codebooks loaded. shape: {codebooks.shape}')
     return codebooks
 
 def perf_sleep(t: float) -> None:
-    t1 = time.perf_counter() + t
-    while time.perf_counter() <= t1:
-        pass
+    """Sleep t seconds, spinning only for the last few milliseconds (see precision_timer.py)"""
+    TIMER.sleep(t)
 
 def random_wait(low: float, high: float):
     """Do nothing for low to high seconds. Duration is random. Between low and high values"""
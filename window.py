@@ -3,7 +3,11 @@ import numpy as np
 from psychopy import visual, event
 from typing import Dict, List
 from pylsl import StreamInfo, StreamOutlet
-from utils import load_codebooks_block_2, load_codebooks_block_3, random_wait
+from utils import random_wait
+from precision_timer import TIMER
+from codebook_archive import get_archive
+from frame_plan import FramePlan, compile_trial
+from io_worker import IOWorker
 
 
 class ScreenStimWindow:
@@ -43,6 +47,9 @@ class ScreenStimWindow:
         # Init marker stream
         info = StreamInfo(name='ScreenMarkerStream', type='Marker', channel_count=1, channel_format=5, nominal_srate=0, source_id='screen_marker_stream_id')
         self.marker_outlet = StreamOutlet(info)
+        # Marker pushes of the trial loops, timestamped right after the flip and pushed in the background
+        self.io = IOWorker(name='screen_io')
+        self.last_trial_report = None
 
     def init_sensor(self):
         # Create a box on top left of screen for vsync sensor
@@ -129,49 +136,46 @@ class ScreenStimWindow:
         for i in range(len(new_poss)):
             self.pictograms[i].pos = new_poss[i]
 
-    def run_trial_erp(self, codebook: list, target_id: int, trial_id: int, n_stim_on_frames: int, n_stim_off_frames: int):
+    def run_trial_erp(self, plan: FramePlan, n_stim_on_frames: int, n_stim_off_frames: int):
         """Run a single trial with multiple sequences on monitor"""
-        self.marker_outlet.push_sample([self.marker_ids['trial_start'] + trial_id]) # Push trial start marker
-        for sequence in codebook:
-            is_target = sequence[target_id]
+        rows, is_target, marker_samples = plan.rows, plan.is_target, plan.marker_samples
+        off_row = [0] * self.n_objs
+        io, outlet = self.io, self.marker_outlet
+        io.push_sample(outlet, plan.start_sample) # Push trial start marker
+        for step_id in range(len(plan)):
+            sensor_color = 'white' if is_target[step_id] else 'black'
             for i in range(n_stim_on_frames):
-                self.draw_sensor_box('white' if is_target == 1 else 'black')
-                self.draw_boxes(sequence)
+                self.draw_sensor_box(sensor_color)
+                self.draw_boxes(rows[step_id])
                 self.draw_pictograms()
                 self.win.flip()
-                # If first sequence and is_target is equal to 1 push to target outlet
+                # Push the target or non-target marker with the first frame of the sequence
                 if i == 0:
-                    if is_target == 1:
-                        self.marker_outlet.push_sample([self.marker_ids['target'] + target_id]) # Push target marker
-                    elif is_target == 0:
-                        self.marker_outlet.push_sample([self.marker_ids['non_target'] + target_id]) # Push non-target marker
-                    else:
-                        ValueError(f'Unknown target value: {is_target}')
+                    io.push_sample(outlet, marker_samples[step_id])
             for i in range(n_stim_off_frames):
                 self.draw_sensor_box('black')
-                self.draw_boxes([0] * 8)
+                self.draw_boxes(off_row)
                 self.draw_pictograms()
                 self.win.flip()
-        self.marker_outlet.push_sample([self.marker_ids['trial_end'] + trial_id]) # Push trial start marker
+        io.push_sample(outlet, plan.end_sample) # Push trial end marker
+        io.flush()
+        self.last_trial_report = {'io': io.stats()}
 
-    def run_trial_cvep(self, codebook: list, target_id: int, trial_id: int):
+    def run_trial_cvep(self, plan: FramePlan):
         """Run a single trial with multiple sequences on monitor"""
-        self.marker_outlet.push_sample([self.marker_ids['trial_start'] + trial_id]) # Push trial start marker
-        for sequence in codebook:
-            is_target = sequence[target_id]
-            self.draw_sensor_box('white' if is_target == 1 else 'black')
-            self.draw_boxes(sequence)
+        rows, is_target, marker_samples = plan.rows, plan.is_target, plan.marker_samples
+        io, outlet = self.io, self.marker_outlet
+        io.push_sample(outlet, plan.start_sample) # Push trial start marker
+        for step_id in range(len(plan)):
+            self.draw_sensor_box('white' if is_target[step_id] else 'black')
+            self.draw_boxes(rows[step_id])
             self.draw_pictograms()
             self.win.flip()
-            # If first sequence and is_target is equal to 1 push to target outlet
-            if is_target == 1:
-                self.marker_outlet.push_sample([self.marker_ids['target'] + target_id]) # Push target marker
-            elif is_target == 0:
-                self.marker_outlet.push_sample([self.marker_ids['non_target'] + target_id]) # Push non-target marker
-            else:
-                ValueError(f'Unknown target value: {is_target}')
+            io.push_sample(outlet, marker_samples[step_id]) # Push target or non-target marker
                     
-        self.marker_outlet.push_sample([self.marker_ids['trial_end'] + trial_id]) # Push trial start marker
+        io.push_sample(outlet, plan.end_sample) # Push trial end marker
+        io.flush()
+        self.last_trial_report = {'io': io.stats()}
 
         # Rest stims after trial
         self.draw_sensor_box('black')
@@ -206,7 +210,7 @@ class ScreenStimWindow:
         self.reorder_pictograms(new_idc)
         
         # run 10 trials with 1 warmup in-between
-        codebook = load_codebooks_block_2()[0].astype(int).tolist()
+        codebook = get_archive().load('condition_2')[0]
         n_on_frames = 6 # 0.1 seconds
         n_off_frames = 9 # 0.15 seconds
         target_id = 0
@@ -214,8 +218,9 @@ class ScreenStimWindow:
         self.screen_warmup(duration=3)
         self.win.recordFrameIntervals = True
         for trial_id in range(n_trials):
+            plan = compile_trial(codebook, target_id=new_idc[target_id], trial_id=trial_id, marker_ids=self.marker_ids)
             start_time = time.perf_counter()
-            self.run_trial_erp(codebook, target_id=new_idc[target_id], trial_id=trial_id, n_stim_on_frames=n_on_frames, n_stim_off_frames=n_off_frames)
+            self.run_trial_erp(plan, n_stim_on_frames=n_on_frames, n_stim_off_frames=n_off_frames)
             elapsed_time = time.perf_counter() - start_time
             trial_run_times.append(elapsed_time)
             self.screen_warmup(duration=3)
@@ -239,13 +244,13 @@ class ScreenStimWindow:
         self.screen_warmup(duration=3)
         self.win.recordFrameIntervals = True
         # run 10 trials with 1 warmup in-between
-        codebook = load_codebooks_block_3()[0].tolist()
-        codebook = codebook[:720]
+        codebook = get_archive().load('condition_3')[0]
 
         trial_run_times = []
         for trial_id in range(n_trials):
+            plan = compile_trial(codebook, target_id=0, trial_id=trial_id, marker_ids=self.marker_ids, n_steps=720)
             start_time = time.perf_counter()
-            self.run_trial_cvep(codebook, target_id=0, trial_id=trial_id)
+            self.run_trial_cvep(plan)
             elapsed_time = time.perf_counter() - start_time
             trial_run_times.append(elapsed_time)
             self.screen_warmup(duration=3)
@@ -307,15 +312,13 @@ class ScreenStimWindow:
             self.draw_boxes([1] * 8)
             self.draw_sensor_box('white')
             self.win.flip()
-            while time.perf_counter() < end_time:
-                pass
+            TIMER.wait_until(end_time)
             
             end_time = time.perf_counter() + self.screen_warmup_duration
             self.draw_boxes([0] * 8)
             self.draw_sensor_box('black')
             self.win.flip()
-            while time.perf_counter() < end_time:
-                pass
+            TIMER.wait_until(end_time)
             
         # Reorder pictograms 5 times
         for _ in range(5):
@@ -325,8 +328,7 @@ class ScreenStimWindow:
             end_time = time.perf_counter() + self.screen_warmup_duration
             self.draw_boxes([1] * 8)
             self.win.flip()
-            while time.perf_counter() < end_time:
-                pass
+            TIMER.wait_until(end_time)
 
         # Test turn screen on/off
         for _ in range(5):
@@ -341,14 +343,12 @@ class ScreenStimWindow:
                 self.draw_sensor_box('white')
                 self.draw_boxes([1] * 8)
                 self.win.flip()
-                while time.perf_counter() < end_time:
-                    pass
+                TIMER.wait_until(end_time)
                 end_time = time.perf_counter() + 1 / self.refresh_rate
                 self.draw_sensor_box('black')
                 self.draw_boxes([0] * 8)
                 self.win.flip()
-                while time.perf_counter() < end_time:
-                    pass
+                TIMER.wait_until(end_time)
         
         # Flip boxes for 5 seconds every frame
         for _ in range(5):
@@ -357,15 +357,13 @@ class ScreenStimWindow:
                 self.draw_sensor_box('white')
                 self.draw_boxes([1] * 8)
                 self.win.flip()
-                while time.perf_counter() < end_time:
-                    pass
+                TIMER.wait_until(end_time)
             for _ in range(60):
                 end_time = time.perf_counter() + 1 / self.refresh_rate
                 self.draw_sensor_box('black')
                 self.draw_boxes([0] * 8)
                 self.win.flip()
-                while time.perf_counter() < end_time:
-                    pass
+                TIMER.wait_until(end_time)
 
         # Log results
         n_dropped_frames = sum(np.array(self.win.frameIntervals) > 1.5 * (1/self.refresh_rate))
@@ -375,6 +373,7 @@ class ScreenStimWindow:
         print(f'Specified refresh rate: {self.refresh_rate}')
         print(f"Actual refresh rate: {self.win.getActualFrameRate()}")
         print(f'# of dropped frames: {n_dropped_frames}')
+        print('Timer wake-up stats:', TIMER.stats())
         self.win.recordFrameIntervals = False
         
         self.disable_stims()